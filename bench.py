@@ -0,0 +1,299 @@
+"""
+Clipy downloader benchmark
+
+A local origin in its own process serves synthetic files with byte ranges, and optionally with
+added latency, limited bandwidth and connections reset part way.  For each level of concurrency
+a fresh process runs the Clipy application, downloads the files through its scheduler as the
+server does and polls ``/api/progress`` over HTTP meanwhile.  Throughput, CPU seconds per GB,
+peak resident memory, event loop lag and progress latency are printed and written to a JSON
+file so runs of different versions can be compared.
+
+    python bench.py
+    python bench.py --concurrency 1,10 --size 64 --latency 0.05 --bandwidth 4000000
+    python bench.py --resets 0.05 --output new.json --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import aiohttp
+import aiohttp.web
+
+import clipy.models
+import clipy.server
+
+CONCURRENCY = '1,3,10,50'  # Downloads at once in each run
+SIZE = 16  # MiB per file
+CHUNK = 2**16  # Bytes the origin writes at a time
+BLOCK = 2**20  # Bytes of random data the origin repeats
+ETAG = '"clipy-bench"'
+LAG_INTERVAL = 0.01  # Seconds between event loop lag samples
+POLL_INTERVAL = 0.1  # Seconds between progress requests
+OUTPUT = 'bench.json'
+
+
+def origin(args, ports):
+    """Serve ``/file/<name>`` of ``args.size`` MiB until terminated, sending the port to ``ports``
+    """
+    block = os.urandom(BLOCK)
+    size = args.size * 2**20
+
+    async def handler(request):
+        rng = request.http_range
+        start = rng.start or 0
+        stop = min(rng.stop or size, size)
+        headers = {'Accept-Ranges': 'bytes', 'ETag': ETAG, 'Content-Length': str(stop - start)}
+        status = 200
+        if rng.start is not None and request.headers.get('If-Range', ETAG) == ETAG:
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        else:
+            start, stop = 0, size
+            headers['Content-Length'] = str(size)
+
+        if args.latency:
+            await asyncio.sleep(args.latency)
+        response = aiohttp.web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+
+        reset = start + random.randrange(stop - start) if random.random() < args.resets else None
+        position = start
+        while position < stop:
+            offset = position % BLOCK
+            length = min(CHUNK, BLOCK - offset, stop - position)
+            if reset is not None and position + length > reset:
+                request.transport.abort()
+                return response
+            await response.write(block[offset:offset + length])
+            position += length
+            if args.bandwidth:
+                await asyncio.sleep(length / args.bandwidth)
+        return response
+
+    async def serve():
+        app = aiohttp.web.Application()
+        app.router.add_get('/file/{name}', handler)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await aiohttp.web.SockSite(runner, sock).start()
+        ports.put(sock.getsockname()[1])
+        while True:
+            await asyncio.sleep(3600)
+
+    logging.disable(logging.CRITICAL)
+    asyncio.get_event_loop().run_until_complete(serve())
+
+
+def scenario(args, concurrency, origin_url):
+    """Download ``concurrency`` files at once through the application and return the measures
+    """
+    logging.disable(logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop.run_until_complete(_scenario(args, concurrency, origin_url))
+
+
+async def _scenario(args, concurrency, origin_url):
+    # The application finds its static files from the repository and downloads to a scratch one
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    app = aiohttp.web.Application(middlewares=[clipy.server.error_middleware])
+    clipy.server.init(app)
+    workdir = tempfile.mkdtemp(prefix='clipy-bench-')
+    os.chdir(workdir)
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    app['server']['sockets'] = [sock]
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.SockSite(runner, sock)
+    await site.start()
+    api_url = 'http://{}:{}/api/progress'.format(*sock.getsockname())
+
+    done = asyncio.Event()
+    states = dict()
+    lags = list()
+    latencies = list()
+
+    def on_transition(job):
+        if job.state in ('finished', 'cancelled', 'failed'):
+            states[job.state] = states.get(job.state, 0) + 1
+            if sum(states.values()) == concurrency:
+                done.set()
+
+    async def sample_lag():
+        while not done.is_set():
+            start = time.monotonic()
+            await asyncio.sleep(LAG_INTERVAL)
+            lags.append(time.monotonic() - start - LAG_INTERVAL)
+
+    async def poll_progress():
+        async with aiohttp.ClientSession() as session:
+            while not done.is_set():
+                start = time.monotonic()
+                async with session.get(api_url) as response:
+                    await response.read()
+                latencies.append(time.monotonic() - start)
+                await asyncio.sleep(POLL_INTERVAL)
+
+    scheduler = app['scheduler']
+    scheduler.concurrency = concurrency
+    scheduler.on_transition.append(on_transition)
+    video = clipy.models.VideoModel('clipy-bench', dict(title='Bench'))
+    streams = [
+        clipy.models.StreamModel(dict(url=f'{origin_url}/file/{i}', filename=f'bench{i}.bin'),
+                                 video, i)
+        for i in range(concurrency)
+    ]
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    monitors = [asyncio.ensure_future(sample_lag()), asyncio.ensure_future(poll_progress())]
+    for stream in streams:
+        scheduler.submit(stream)
+    await done.wait()
+    seconds = time.monotonic() - started
+    await asyncio.gather(*monitors)
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    bytesdone = sum(s.progress.bytesdone for s in streams)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    await runner.cleanup()
+    os.chdir(cwd)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return dict(
+        concurrency=concurrency,
+        bytes=bytesdone,
+        seconds=seconds,
+        mb_per_second=bytesdone / seconds / 2**20,
+        cpu_seconds_per_gb=cpu / (bytesdone / 2**30) if bytesdone else None,
+        peak_rss_mb=after.ru_maxrss / 1024,
+        loop_lag_ms=_summary(lags),
+        progress_latency_ms=_summary(latencies),
+        states=states,
+    )
+
+
+def _summary(seconds):
+    """Median, 99th percentile and maximum of the samples in milliseconds
+
+    >>> _summary([0.001, 0.002, 0.003])
+    {'p50': 2.0, 'p99': 3.0, 'max': 3.0, 'samples': 3}
+    """
+    values = sorted(seconds)
+    if not values:
+        return dict(p50=None, p99=None, max=None, samples=0)
+
+    def percentile(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 3)
+
+    return dict(p50=percentile(0.5), p99=percentile(0.99), max=percentile(1), samples=len(values))
+
+
+def _version():
+    try:
+        output = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_result(result):
+    print('{concurrency:>4} {mb_per_second:9.1f} {cpu:10.2f} {peak_rss_mb:9.1f} {lag:>10} {api:>10}'
+          ' {states}'.format(
+              cpu=result['cpu_seconds_per_gb'] or 0,
+              lag=result['loop_lag_ms']['p99'],
+              api=result['progress_latency_ms']['p99'],
+              **result))
+
+
+def _compare(results, path):
+    """Print the change of each measure from the results saved at ``path``"""
+    with open(path) as fd:
+        previous = {r['concurrency']: r for r in json.load(fd)['results']}
+
+    def change(new, old):
+        return f'{(new - old) / old:+.0%}' if new is not None and old else '-'
+
+    print(f'\nchange from {path}')
+    for result in results:
+        old = previous.get(result['concurrency'])
+        if old is None:
+            continue
+        print('{:>4} {:>9} {:>10} {:>9} {:>10} {:>10}'.format(
+            result['concurrency'],
+            change(result['mb_per_second'], old['mb_per_second']),
+            change(result['cpu_seconds_per_gb'], old['cpu_seconds_per_gb']),
+            change(result['peak_rss_mb'], old['peak_rss_mb']),
+            change(result['loop_lag_ms']['p99'], old['loop_lag_ms']['p99']),
+            change(result['progress_latency_ms']['p99'], old['progress_latency_ms']['p99']),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clipy downloader benchmark')
+    parser.add_argument('--concurrency', default=CONCURRENCY,
+                        help=f'comma separated downloads at once per run, default {CONCURRENCY}')
+    parser.add_argument('--size', type=int, default=SIZE, help=f'MiB per file, default {SIZE}')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the origin waits before each response')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second per origin response, 0 for unlimited')
+    parser.add_argument('--resets', type=float, default=0.0,
+                        help='chance that the origin resets a response part way')
+    parser.add_argument('--output', default=OUTPUT, help=f'results file, default {OUTPUT}')
+    parser.add_argument('--compare', help='results file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    server = context.Process(target=origin, args=(args, ports), daemon=True)
+    server.start()
+    origin_url = f'http://127.0.0.1:{ports.get(timeout=30)}'
+
+    results = list()
+    print('conc      MB/s   CPU s/GB   RSS MiB lag p99 ms api p99 ms states')
+    try:
+        for concurrency in (int(c) for c in args.concurrency.split(',')):
+            with context.Pool(1) as pool:
+                result = pool.apply(scenario, (args, concurrency, origin_url))
+            _print_result(result)
+            results.append(result)
+    finally:
+        server.terminate()
+
+    report = dict(
+        version=_version(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        params=vars(args),
+        results=results,
+    )
+    with open(args.output, 'w') as fd:
+        json.dump(report, fd, indent=2)
+    print(f'\nwrote {args.output}')
+
+    if args.compare:
+        _compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,69 @@
 
 class Agent():
-    def __init__(self, lookup):
+    INFO_FIELDS = None  # Upstream info fields kept once parsed, None to keep them all
+    TEXT_FIELDS = ('description',)  # Free text fields that are cut to MAX_TEXT characters
+    MAX_TEXT = 1000
+
+    def __init__(self, lookup, session, cache=None):
         self.lookup = lookup
+        self.session = session
+        self.cache = cache
 
     async def get_video(self):
         video = await self._get_video()
         self.load_video_streams(video)
+        for stream in video.streams:
+            stream.agent = self.__class__.__name__
         return video
 
     async def get_stream(self, idx):
         video = await self._get_video()
+        return self.load_stream(video, idx)
+
+    def load_stream(self, video, idx):
+        """Load the video's stream at ``idx`` in full, ready to download"""
         self.load_video_stream(video, idx)
+        video.stream.agent = self.__class__.__name__
         return video.stream
+
+    async def refresh_url(self, stream):
+        """Return a new signed URL of the stream, from info fetched again
+
+        The stream is found among the video's formats by its ``key``, its vid and itag or type,
+        so it is the same content wherever the format now is in the list.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(self._get_cache_key(stream.vid))
+        video = await self._get_video()
+        self.load_video_streams(video)
+        for summary in video.streams:
+            if summary.key == stream.key:
+                return self.load_stream(video, summary.index).url
+        raise ValueError(f'Stream {stream.key} is no longer offered')
+
+    async def _get_cached_info(self, vid):
+        """Return the video info from the metadata cache, fetching it on a miss"""
+        async def fetch():
+            return self._trim_info(await self._get_info(vid))
+
+        if self.cache is None:
+            return await fetch()
+
+        return await self.cache.get(self._get_cache_key(vid), fetch, self._get_expiry)
+
+    def _get_cache_key(self, vid):
+        return f'{self.__class__.__name__}:{vid}'
+
+    def _trim_info(self, info):
+        """Return the info with only the fields the agent uses, so less is held and cached"""
+        if self.INFO_FIELDS is not None:
+            info = {k: v for k, v in info.items() if k in self.INFO_FIELDS}
+        for field in self.TEXT_FIELDS:
+            text = info.get(field)
+            if isinstance(text, str) and len(text) > self.MAX_TEXT:
+                info = dict(info, **{field: text[:self.MAX_TEXT]})
+        return info
+
+    def _get_expiry(self, info):
+        """Return when the signed stream URLs in the info expire, in seconds since the epoch"""
+        return None
@@ -4,23 +4,28 @@ from .youtube import YoutubeAgent
 from .vidme import VidmeAgent
 
 
-def lookup_agent(url: str):
+def lookup_agent(url: str, session, cache=None):
     parts = urllib.parse.urlsplit(url)
 
     if 'youtube' in parts.netloc:
-        return YoutubeAgent(url)
+        return YoutubeAgent(url, session, cache)
 
     elif 'vid.me' in parts.netloc:
-        return VidmeAgent(url)
+        return VidmeAgent(url, session, cache)
 
-    return get_agent(url)
+    return get_agent(url, session, cache)
 
 
-def get_agent(vid: str):
+def get_agent(vid: str, session, cache=None):
     if len(vid) == 11:
-        return YoutubeAgent(vid)
+        return YoutubeAgent(vid, session, cache)
 
     elif len(vid) == 4:
-        return VidmeAgent(vid)
+        return VidmeAgent(vid, session, cache)
 
     raise Exception(f'No suitable video agent found for: {vid}')
+
+
+async def refresh_url(stream, session, cache=None):
+    """Return a new signed URL of the stream from the agent of its video"""
+    return await get_agent(stream.vid, session, cache).refresh_url(stream)
@@ -5,10 +5,15 @@ import clipy.agents
 import clipy.models
 import clipy.request
 
+from clipy.utils import take_first as tf
+
 logger = logging.getLogger(__name__)
 
 
 class VidmeAgent(clipy.agents.Agent):
+    INFO_FIELDS = ('title', 'description', 'duration', 'thumbnail_url', 'user', 'formats')
+    FORMAT_FIELDS = ('type', 'uri', 'width', 'height', 'version')
+
     def __init__(self, *args):
         super().__init__(*args)
 
@@ -19,8 +24,14 @@ class VidmeAgent(clipy.agents.Agent):
         video: <clipy.models.VideoModel object>
         """
         vid = self._get_video_id()
-        info = await self._get_info(vid)
-        video = clipy.models.VideoModel(vid, info)
+        info = await self._get_cached_info(vid)
+        video = clipy.models.VideoModel(
+            vid, info,
+            author=info.get('user', {}).get('username'),
+            duration=info.get('duration'),
+            description=info.get('description'),
+            thumbnail=info.get('thumbnail_url'),
+        )
         return video
 
     def _get_video_id(self) -> None:
@@ -31,10 +42,29 @@ class VidmeAgent(clipy.agents.Agent):
 
     async def _get_info(self, vid):
         url = f'https://api.vid.me/videoByUrl/{vid}'
-        data = await clipy.request.get_json(url)
+        data = await clipy.request.get_json(self.session, url)
         return data['video']
         # return data['video']['complete_url']
 
+    def _trim_info(self, info):
+        info = super()._trim_info(info)
+        user = info.get('user') or {}
+        return dict(
+            info,
+            user=dict(username=user.get('username')),
+            formats=[
+                {k: v for k, v in f.items() if k in self.FORMAT_FIELDS}
+                for f in info.get('formats') or ()
+            ],
+        )
+
+    def _get_expiry(self, info):
+        for data in info.get('formats') or ():
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(data.get('uri') or '').query)
+            expires = tf(query.get('Expires'))
+            if expires:
+                return int(expires)
+
     def _get_stream(self, video, data, index):
         """
         data::
@@ -54,17 +84,19 @@ class VidmeAgent(clipy.agents.Agent):
             parts = urllib.parse.urlsplit(data['uri'])
             return parts.path.partition('.')[2]
 
-        name = video.name or video.title
+        name = video.title
         width = data.get('width')
         height = data.get('height')
         version = data.get('version')
         dimensions = f'{width}x({height})' if width and height else ''
-        user = video.info['user']['username']
+        user = video.author
         type = data.get('type', '')
         ext = extension()
         filename = f'{user}_{name}-({type}){video.vid}.{ext}'.replace('/', '|')
 
-        data.update(
+        # copy, the info may be shared through the metadata cache
+        data = dict(
+            data,
             display=f'{type} {dimensions} v{version}',
             filename=clipy.models.StreamModel.safe_name(filename),
             url=data.get('uri'),
@@ -77,12 +109,12 @@ class VidmeAgent(clipy.agents.Agent):
         self = <clipy.agents.VidmeAgent object at 0x7f35787c94e0>
         video = <clipy.models.VideoModel object at 0x7f35787c9518>
         """
-        for i, stream_format in enumerate(video.formats):
+        for i, stream_format in enumerate(video.info['formats']):
             stream = self._get_stream(video, stream_format, i)
             video.streams.append(stream)
 
     def load_video_stream(self, video, stream_index: int):
         i = int(stream_index)
-        stream_format = video.formats[i]
+        stream_format = video.info['formats'][i]
         stream = self._get_stream(video, stream_format, i)
         video.stream = stream
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import urllib.parse
 
@@ -9,19 +10,85 @@ from clipy.utils import take_first as tf
 
 logger = logging.getLogger(__name__)
 
+BASE_URL = 'https://www.youtube.com'
+PREFETCH = 8  # Videos of a playlist whose info is fetched at once
+MAX_ENTRIES = 5000  # Most videos taken from one playlist or channel
+CHANNEL_NAMES = ('/user/', '/c/')  # Paths of channel URLs by name instead of id
+
 
 class YoutubeAgent(clipy.agents.Agent):
+    INFO_FIELDS = (
+        'status', 'video_id', 'title', 'author', 'length_seconds', 'thumbnail_url', 'view_count',
+        'url_encoded_fmt_stream_map', 'adaptive_fmts',
+    )
+
     def __init__(self, *args):
         super().__init__(*args)
+        self.base_url = BASE_URL
+
+    @property
+    def is_list(self):
+        return _get_list_id(self.lookup) is not None
+
+    async def get_video_ids(self):
+        """Expand the playlist or channel into its video ids, a page at a time
+
+        A channel is expanded to its uploads playlist.
+        """
+        list_id = _get_list_id(self.lookup)
+        if list_id is None:
+            return [self._get_video_id()]
+
+        vids = list()
+        seen = set()
+        position = 0  # Of the last entry read, repeated entries included
+        while position < MAX_ENTRIES:
+            query = urllib.parse.urlencode(
+                dict(style='json', action_get_list=1, list=list_id, index=position + 1))
+            url = f'{self.base_url}/list_ajax?{query}'
+            page = await clipy.request.get_json(self.session, url)
+            entries = page.get('video', ())
+            if not entries:
+                break
+            position += len(entries)
+            for entry in entries:
+                vid = entry['encrypted_id']
+                if vid not in seen:
+                    seen.add(vid)
+                    vids.append(vid)
+        logger.debug(f'{self.__class__.__name__} "{self.lookup}" --> {len(vids)} videos')
+        return vids[:MAX_ENTRIES]
+
+    async def get_videos(self, concurrency=PREFETCH):
+        """Return the vid and video of every entry in the playlist, with its streams loaded
+
+        The entries' info is fetched ``concurrency`` at a time into the metadata cache.  An entry
+        that cannot be fetched has the exception raised for it in place of the video.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get_video(vid):
+            agent = YoutubeAgent(vid, self.session, self.cache)
+            agent.base_url = self.base_url
+            async with semaphore:
+                return await agent.get_video()
+
+        vids = await self.get_video_ids()
+        videos = await asyncio.gather(*(get_video(v) for v in vids), return_exceptions=True)
+        return list(zip(vids, videos))
 
     async def _get_video(self):
         vid = self._get_video_id()
-        info = await self._get_info(vid)
-        video = clipy.models.VideoModel(vid, info)
-        video.info_map = dict(
-            videoid='video_id',
-            duration='length_seconds',
+        info = await self._get_cached_info(vid)
+        video = clipy.models.VideoModel(
+            vid, info,
+            author=info.get('author'),
+            duration=info.get('length_seconds'),
+            thumbnail=info.get('thumbnail_url'),
         )
+        if self.cache is not None:
+            # Kept with the cached info so the formats are scanned once per video, not per lookup
+            video.stream_index = self.cache.derive(self._get_cache_key(vid), info, StreamIndex)
         return video
 
     def _get_video_id(self) -> None:
@@ -36,50 +103,90 @@ class YoutubeAgent(clipy.agents.Agent):
         return self.lookup
 
     async def _get_info(self, vid):
-        url = f'https://www.youtube.com/get_video_info?video_id={vid}'
-        data = await clipy.request.get_text(url)
+        url = f'{self.base_url}/get_video_info?video_id={vid}'
+        data = await clipy.request.get_text(self.session, url)
         info = {k: tf(v) for k, v in urllib.parse.parse_qs(data).items()}
         if info.get('status') == 'ok':
             return info
         else:
             raise ValueError(f'Invalid video Id "{vid}" {info}')
 
-    def _get_stream(self, video, string, index):
-        name = video.name or video.title
-        data = {k: tf(v) for k, v in urllib.parse.parse_qs(string).items()}
+    def _get_expiry(self, info):
+        for string in _get_stream_map(info):
+            url = _get_field(string, 'url')
+            if url:
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+                expire = tf(query.get('expire'))
+                return int(expire) if expire else None
+
+    def _get_stream(self, video, data, index):
+        name = video.title
         quality = data.get('quality', '')
         type = data.get('type', '')
         itag = data.get('itag')
         itags = _get_itags(itag)
         res = _get_resolution(itag)
         ext = _get_extension(itag)
-        author = video.info.get('author')
-        filename = f'{author}_{name}-({res}){video.vid}.{ext}'.replace('/', '|')
+        filename = f'{video.author}_{name}-({res}){video.vid}.{ext}'.replace('/', '|')
 
         data.update(
             display=f'{itags} {quality} ({res}) {type}',
             filename=clipy.models.StreamModel.safe_name(filename),
-            title=video.info.get('title', name),
+            title=name,
         )
         stream = clipy.models.StreamModel(data, video, index)
         return stream
 
     def load_video_streams(self, video):
+        """Load a summary of every stream, without the url, for the client to choose from"""
         if video.info is not None:
-            # first we split the mapping on the commas
-            stream_map = _get_stream_map(video.info)
-            # collect all streams data since we don't have a stream index
-            for i, string in enumerate(stream_map):
-                stream = self._get_stream(video, string, i)
+            formats = _get_stream_index(video)
+            for i in range(len(formats)):
+                stream = self._get_stream(video, formats.summary(i), i)
                 video.streams.append(stream)
 
     def load_video_stream(self, video, index):
         if video.info is not None:
-            # first we split the mapping on the commas
-            stream_map = _get_stream_map(video.info)
-            # Just collect the stream we want
-            string = stream_map[int(index)]
-            video.stream = self._get_stream(video, string, int(index))
+            formats = _get_stream_index(video)
+            video.stream = self._get_stream(video, formats.parse(int(index)), int(index))
+
+
+class StreamIndex():
+    """The formats of a video's stream map, each decoded only when it is used
+
+    ``itags`` maps each itag to the position of its format, found without decoding the formats.
+    A ``summary`` decodes just the fields shown to the client and ``parse`` the whole format.
+    """
+    __slots__ = ('formats', 'itags', '_parsed')
+
+    SUMMARY = ('itag', 'type', 'quality')
+
+    def __init__(self, info):
+        self.formats = _get_stream_map(info)
+        self.itags = dict()
+        for i, string in enumerate(self.formats):
+            self.itags.setdefault(_get_field(string, 'itag'), i)
+        self._parsed = dict()
+
+    def __len__(self):
+        return len(self.formats)
+
+    def summary(self, index):
+        data = dict()
+        for pair in self.formats[index].split('&'):
+            name, _, value = pair.partition('=')
+            if name in self.SUMMARY and name not in data:
+                data[name] = urllib.parse.unquote_plus(value)
+        return data
+
+    def parse(self, index):
+        data = self._parsed.get(index)
+        if data is None:
+            string = self.formats[index]
+            data = self._parsed[index] = {
+                k: tf(v) for k, v in urllib.parse.parse_qs(string).items()}
+        # copy, the stream adds its own fields
+        return dict(data)
 
 
 # Taken from from Pafy https://github.com/np1/pafy
@@ -152,3 +259,73 @@ def _get_extension(itag):
 def _get_stream_map(info):
     return (tf(info.get('url_encoded_fmt_stream_map', '')).split(',') +
             tf(info.get('adaptive_fmts', '')).split(','))
+
+
+def _get_stream_index(video):
+    """Return the video's stream index, built the first time it is needed"""
+    if video.stream_index is None:
+        video.stream_index = StreamIndex(video.info)
+    return video.stream_index
+
+
+def _get_field(string, name):
+    """Decode one field of a url encoded format without decoding the others
+
+    >>> _get_field('itag=18&type=video%2Fmp4%3B+codecs&url=http%3A%2F%2Fx', 'type')
+    'video/mp4; codecs'
+    """
+    prefix = name + '='
+    for pair in string.split('&'):
+        if pair.startswith(prefix):
+            return urllib.parse.unquote_plus(pair[len(prefix):])
+    return None
+
+
+def select_stream(video, profile):
+    """Return the video's stream for the profile, an itag or ``best`` or ``audio``, or None
+
+    ``best`` is the stream of highest resolution with both video and audio and ``audio`` is
+    the audio only stream of highest bitrate.
+    """
+    def itag(stream):
+        return getattr(stream, 'itag', None)
+
+    def size(stream):
+        numbers = _get_resolution(itag(stream)).rstrip('k').split('x')
+        return tuple(int(n) for n in numbers if n.isdigit())
+
+    if profile == 'best':
+        kind = 'normal'
+    elif profile == 'audio':
+        kind = 'audio'
+    else:
+        index = _get_stream_index(video).itags.get(profile)
+        return next((s for s in video.streams if s.index == index), None)
+
+    streams = [s for s in video.streams if ITAGS.get(itag(s), ('', '', ''))[2] == kind]
+    return max(streams, key=size, default=None)
+
+
+def _get_list_id(url):
+    """Return the id of the playlist, or channel uploads, the url is for
+
+    A channel known by its name rather than its id is refused, its uploads cannot be listed.
+
+    >>> _get_list_id('https://www.youtube.com/playlist?list=PLabc')
+    'PLabc'
+    >>> _get_list_id('https://www.youtube.com/channel/UCxyz/videos')
+    'UUxyz'
+    >>> _get_list_id('https://www.youtube.com/watch?v=abcdefghijk&list=PLabc')
+    >>> _get_list_id('https://www.youtube.com/user/name')
+    Traceback (most recent call last):
+    ...
+    ValueError: Channel by name, use its /channel/UC... URL: https://www.youtube.com/user/name
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.path == '/playlist':
+        return tf(urllib.parse.parse_qs(parts.query).get('list'))
+    if parts.path.startswith('/channel/UC'):
+        return 'UU' + parts.path.split('/')[2][2:]
+    if parts.path.startswith(CHANNEL_NAMES):
+        raise ValueError(f'Channel by name, use its /channel/UC... URL: {url}')
+    return None
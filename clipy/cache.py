@@ -0,0 +1,153 @@
+"""
+Clipy video metadata cache
+
+Upstream video information is kept for a while so a download following an inquiry, or a
+repeated inquiry, does not fetch it again.  Entries expire after ``TTL`` seconds, or earlier
+when the stream URLs they contain are signed to expire sooner, and the least recently used
+entries are evicted beyond ``MAXSIZE``.  What is derived from an entry, like an index of its
+streams, can be kept with it and goes when it does.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import collections
+
+logger = logging.getLogger(__name__)
+
+TTL = 3600  # Seconds an entry is kept at most
+MARGIN = 600  # Seconds before its signed URLs expire that an entry is dropped
+MAXSIZE = 1024  # Entries kept before the least recently used is evicted
+
+
+class MetadataCache():
+    """LRU cache of metadata with per-entry expiry and coalesced lookups
+
+    Concurrent ``get`` calls for a key that is not cached share a single call of ``fetch``.  If
+    ``path`` is given the unexpired entries are loaded from, and saved to, that JSON file.
+    """
+    def __init__(self, ttl=TTL, maxsize=MAXSIZE, path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.derived = dict()
+        self.inflight = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'<MetadataCache {len(self.entries)} entries {self.hits} hits {self.misses} misses>'
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key):
+        """Return the cached value or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires <= time.time():
+            self.invalidate(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, expires=None):
+        """Cache the value until ``expires`` seconds since the epoch, or at most ``ttl`` seconds"""
+        limit = time.time() + self.ttl
+        expires = min(expires - MARGIN, limit) if expires else limit
+        self.derived.pop(key, None)
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.derived.pop(self.entries.popitem(last=False)[0], None)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        self.derived.pop(key, None)
+
+    def derive(self, key, value, build):
+        """Return ``build(value)``, built once for as long as value is the one cached for key"""
+        derived = self.derived.get(key)
+        if derived is not None and derived[0] is value:
+            return derived[1]
+
+        result = build(value)
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] is value:
+            self.derived[key] = (value, result)
+        return result
+
+    async def get(self, key, fetch, expiry=None):
+        """Return the cached value for key, or await ``fetch()`` and cache what it returns
+
+        ``expiry``, if given, is called with the fetched value and returns the time its signed
+        URLs expire, or None.  If the call doing the fetch is cancelled the calls waiting on it
+        try again.
+        """
+        value = self.lookup(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.hits += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            # The lookup being waited on was cancelled, make our own
+            return await self.get(key, fetch, expiry)
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self.inflight[key] = future
+        try:
+            value = await fetch()
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved, the waiters if any get it too
+            raise
+        else:
+            future.set_result(value)
+            self.put(key, value, expiry(value) if expiry else None)
+            return value
+        finally:
+            del self.inflight[key]
+            if not future.done():
+                future.cancel()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as fd:
+                entries = json.load(fd)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Cannot load cache {self.path}: {e}')
+            return
+
+        now = time.time()
+        for key, (expires, value) in entries:
+            if expires > now:
+                self.entries[key] = (expires, value)
+        logger.info(f'loaded {self.path}: {self}')
+
+    def save(self):
+        if not self.path:
+            return
+
+        now = time.time()
+        entries = [(k, e) for k, e in self.entries.items() if e[0] > now]
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as fd:
+            json.dump(entries, fd)
+        logger.info(f'saved {self.path}: {self}')
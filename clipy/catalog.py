@@ -0,0 +1,135 @@
+"""
+Clipy catalog of completed downloads
+
+Every file finished in the download directory is recorded by its stream ``key``, the vid and
+format, and by filename with its size, modification time and CRC-32.  The catalog is saved to a
+JSON file and brought up to date with the directory by one scan at startup, after which it is
+kept current as downloads finish, so asking whether a stream is already held never lists the
+directory.  Files found by the scan that were not downloaded here have no key or checksum and
+are known by filename only.
+"""
+import os
+import json
+import zlib
+import asyncio
+import logging
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 2**20  # Bytes read at a time for the checksum
+PARTIAL = ('.clipy', '.manifest', '.tmp')  # Suffixes of files still being downloaded
+
+_executor = None
+
+
+def _get_executor():
+    # Files are reread in a thread of their own, hashing a large one would otherwise hold up
+    # the writes of other downloads in the writer pool
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(1, 'clipy-catalog')
+    return _executor
+
+
+class Catalog():
+    """Completed downloads in ``directory``, by stream key and by filename
+
+    ``entries`` maps each filename to its ``key``, ``size``, ``mtime`` and ``checksum``.
+    """
+    def __init__(self, directory, path=None):
+        self.directory = directory
+        self.path = path
+        self.entries = dict()
+        self.keys = dict()
+
+    def __repr__(self):
+        return f'<Catalog {self.directory} {len(self.entries)} files>'
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, stream):
+        """Return the entry of the stream's file, or None
+
+        Only the one file is looked at, in case it was removed since it was recorded.
+        """
+        filename = self.keys.get(stream.key, stream.filename)
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        if not os.path.exists(os.path.join(self.directory, filename)):
+            self.remove(filename)
+            return None
+        return entry
+
+    async def add(self, stream):
+        """Record the stream's file, which has just been completed"""
+        loop = asyncio.get_event_loop()
+        entry = await loop.run_in_executor(_get_executor(), self._describe, stream.filename)
+        self._put(stream.filename, dict(entry, key=stream.key))
+        logger.debug(f'{stream.filename} added to {self}')
+
+    def remove(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is not None and self.keys.get(entry['key']) == filename:
+            del self.keys[entry['key']]
+
+    def scan(self):
+        """Drop the entries of files that are gone or changed and add files not yet recorded"""
+        found = dict()
+        if os.path.isdir(self.directory):
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if item.is_file() and not item.name.endswith(PARTIAL):
+                        found[item.name] = item.stat()
+
+        for filename, entry in list(self.entries.items()):
+            info = found.get(filename)
+            if info is None or (info.st_size, info.st_mtime) != (entry['size'], entry['mtime']):
+                self.remove(filename)
+        for filename, info in found.items():
+            if filename not in self.entries:
+                self._put(filename, dict(
+                    key=None, size=info.st_size, mtime=info.st_mtime, checksum=None))
+        logger.info(f'scanned {self.directory}: {self}')
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as fd:
+                entries = json.load(fd)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Cannot load catalog {self.path}: {e}')
+            return
+
+        for filename, entry in entries.items():
+            self._put(filename, entry)
+        logger.info(f'loaded {self.path}: {self}')
+
+    def save(self):
+        if not self.path:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as fd:
+            json.dump(self.entries, fd)
+        os.replace(f'{self.path}.tmp', self.path)
+        logger.info(f'saved {self.path}: {self}')
+
+    def _describe(self, filename):
+        path = os.path.join(self.directory, filename)
+        crc = 0
+        with open(path, 'rb') as fd:
+            for block in iter(lambda: fd.read(BLOCK), b''):
+                crc = zlib.crc32(block, crc)
+        info = os.stat(path)
+        return dict(size=info.st_size, mtime=info.st_mtime, checksum=crc)
+
+    def _put(self, filename, entry):
+        self.remove(filename)
+        self.entries[filename] = entry
+        if entry['key']:
+            self.keys[entry['key']] = filename
@@ -1,8 +1,11 @@
 import webbrowser
 
+import clipy.config
 
-def main():
-    webbrowser.open_new('http://127.0.0.1:7070')
+
+def main(argv=None):
+    config = clipy.config.load(argv)
+    webbrowser.open_new(f'http://{config["host"]}:{config["port"]}')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+"""
+Clipy server configuration
+
+Settings are taken from, in increasing order of precedence, the defaults, the chosen profile, a
+YAML or JSON file, ``CLIPY_*`` environment variables and the ``clipyd`` command line:
+
+    clipyd --config clipy.yaml --port 8080
+    CLIPY_PROFILE=development CLIPY_LOG_LEVELS=clipy.download=DEBUG clipyd
+
+The ``production`` profile, the default, runs without debug instrumentation; ``development``
+turns on asyncio debug mode, DEBUG logging, the access log and slow callback reports.  A file
+may also have a ``logging`` section for ``logging.config.dictConfig``, see ``logger.yaml``.
+"""
+import os
+import json
+import asyncio
+import logging
+import logging.config
+import argparse
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import clipy.download
+import clipy.request
+import clipy.scheduler
+
+logger = logging.getLogger(__name__)
+
+# Name, type, default and help of every setting; a default of None is set by the profile
+SETTINGS = (
+    ('profile', str, 'production', 'production or development'),
+    ('host', str, '127.0.0.1', 'address to listen on'),
+    ('port', int, 7070, 'port to listen on'),
+    ('download_dir', str, clipy.download.DIRECTORY, 'directory downloads are saved in'),
+    ('data_dir', str, 'data', 'directory the metadata cache, catalog and job store are kept in'),
+    ('concurrency', int, clipy.scheduler.CONCURRENCY, 'downloads run at once'),
+    ('segments', int, clipy.download.SEGMENTS, 'byte ranges fetched at once for each download'),
+    ('connections', int, clipy.request.LIMIT, 'upstream connections open at once'),
+    ('connections_per_host', int, clipy.request.LIMIT_PER_HOST,
+     'upstream connections open at once to one host'),
+    ('rate', int, 0, 'bytes per second for all downloads together, 0 for no limit'),
+    ('retries', int, clipy.download.RETRIES, 'reconnections allowed for each download'),
+    ('stall', float, clipy.download.STALL, 'seconds without data before a download is stalled'),
+    ('loop', str, 'auto', 'event loop: auto (uvloop when installed), asyncio or uvloop'),
+    ('log_level', str, None, 'level of the root logger'),
+    ('log_levels', dict, {}, 'levels of named loggers as name=LEVEL,...'),
+    ('debug', bool, None, 'asyncio debug mode'),
+    ('access_log', bool, None, 'log every request'),
+    ('slow_callback', float, None, 'seconds a callback may hold the loop before it is reported'),
+)
+
+PROFILES = dict(
+    production=dict(log_level='INFO', debug=False, access_log=False, slow_callback=0.0),
+    development=dict(log_level='DEBUG', debug=True, access_log=True, slow_callback=0.1),
+)
+
+TYPES = {name: type for name, type, default, help in SETTINGS}
+
+
+def get_defaults(profile='production'):
+    """Return the settings of the profile with nothing overridden"""
+    config = {name: type(default) if default else default for name, type, default, _ in SETTINGS}
+    config.update(PROFILES[profile], profile=profile, logging=None)
+    return config
+
+
+def load(argv=None, environ=None):
+    """Return the settings from the file, environment and command line ``argv``"""
+    environ = os.environ if environ is None else environ
+    args = _get_parser().parse_args(argv)
+
+    overrides = list()
+    path = args.config or environ.get('CLIPY_CONFIG')
+    if path:
+        overrides.append(_read_file(path))
+    overrides.append({
+        name: _parse(name, environ[f'CLIPY_{name.upper()}'])
+        for name in TYPES if f'CLIPY_{name.upper()}' in environ
+    })
+    overrides.append({
+        name: value for name, value in vars(args).items() if name in TYPES and value is not None
+    })
+
+    profile = 'production'
+    for override in overrides:
+        profile = override.get('profile', profile)
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown profile "{profile}", one of {", ".join(PROFILES)}')
+
+    config = get_defaults(profile)
+    for override in overrides:
+        config.update(override)
+    return config
+
+
+def configure_logging(config):
+    """Set up logging from the ``logging`` section if there is one, else from the levels"""
+    if config['logging']:
+        logging.config.dictConfig(config['logging'])
+    else:
+        logging.basicConfig(level=config['log_level'].upper())
+    for name, level in config['log_levels'].items():
+        logging.getLogger(name).setLevel(level.upper())
+
+
+def install_loop(config):
+    """Use the uvloop event loop when it is asked for, or installed and ``loop`` is ``auto``"""
+    if config['loop'] == 'asyncio':
+        return
+
+    try:
+        import uvloop
+    except ImportError:
+        if config['loop'] == 'uvloop':
+            raise
+        return
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info(f'using uvloop {uvloop.__version__}')
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description='Clipy video download server')
+    parser.add_argument('--config', help='YAML or JSON file of settings')
+    for name, type, default, help in SETTINGS:
+        option = '--' + name.replace('_', '-')
+        if type is bool:
+            parser.add_argument(option, dest=name, action='store_const', const=True, help=help)
+            parser.add_argument('--no-' + name.replace('_', '-'), dest=name,
+                                action='store_const', const=False)
+        else:
+            default = 'by profile' if default is None else default
+            parser.add_argument(option, dest=name, type=lambda v, n=name: _parse(n, v),
+                                help=f'{help}, default {default}')
+    return parser
+
+
+def _read_file(path):
+    with open(path) as fd:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError(f'PyYAML is needed to read {path}')
+            settings = yaml.safe_load(fd) or dict()
+        else:
+            settings = json.load(fd)
+
+    unknown = set(settings) - set(TYPES) - {'logging'}
+    if unknown:
+        raise ValueError(f'Unknown settings in {path}: {", ".join(sorted(unknown))}')
+    return {
+        name: _parse(name, value) if isinstance(value, str) else value
+        for name, value in settings.items()
+    }
+
+
+def _parse(name, value):
+    """Convert the string value of a setting to the setting's type
+
+    >>> _parse('port', '8080')
+    8080
+    >>> _parse('debug', 'yes')
+    True
+    >>> _parse('log_levels', 'clipy=DEBUG, aiohttp.access=WARNING')
+    {'clipy': 'DEBUG', 'aiohttp.access': 'WARNING'}
+    """
+    type = TYPES.get(name, str)
+    if type is bool:
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if type is dict:
+        pairs = (item.split('=', 1) for item in value.split(',') if item.strip())
+        return {k.strip(): v.strip() for k, v in pairs}
+    return type(value)
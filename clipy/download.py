@@ -8,98 +8,364 @@ Traceback (most recent call last):
 ConnectionResetError: [Errno 104] Connection reset by peer
 """
 import os
-import time
+import re
+import random
 import asyncio
 import logging
 
 import aiohttp
 
+import clipy.manifest
+import clipy.metrics
+import clipy.throttle
+import clipy.writer
+
 logger = logging.getLogger(__name__)
-semaphore = asyncio.Semaphore(3)  # Limit number of downloads for calls to ``get``
 
+DIRECTORY = 'videos'  # Where downloads are saved
+SEGMENTS = 4  # Concurrent byte ranges per stream when the server accepts them
+MIN_SEGMENT = 2**22  # Streams are not split into ranges smaller than this
+SAVE_INTERVAL = 2  # Seconds between saves of the manifest
+RETRIES = 5  # Reconnections allowed for one download
+BACKOFF = 1.0  # Seconds before the first reconnection, doubled for each one after
+MAX_BACKOFF = 60.0  # Most seconds before a reconnection
+STALL = 30.0  # Seconds without data before a download is stalled
+EXPIRED = (403, 410)  # Statuses of a request whose signed URL has expired
+
+
+class SourceChanged(Exception):
+    """The server's content no longer matches the partial download"""
+
+
+class RetryPolicy():
+    """When a failed download reconnects and how long it waits first
+
+    Connection resets, timeouts, responses cut short and server errors are retried after an
+    exponential backoff with full jitter, until the download has used its budget of ``retries``;
+    the count is kept in the stream's progress.  A connection that has had no data for twice
+    ``stall`` seconds is dropped and retried, see ``clipy.scheduler`` for the stalled state.
+
+    A request refused as ``EXPIRED`` is retried at once with the URL awaited from
+    ``refresh(stream)``, if given; the segments of a stream refused together share one refresh.
+    """
+    def __init__(self, retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF, stall=STALL,
+                 refresh=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stall = stall
+        self.refresh = refresh
+        self.refreshing = dict()
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_read=2 * stall)
+
+    def __repr__(self):
+        return f'<RetryPolicy {self.retries} retries, backoff {self.backoff} s>'
+
+    async def wait(self, stream, error):
+        """Count a retry of the stream after ``error`` and wait, or raise the error if it is
+        permanent or the budget is spent
+        """
+        progress = stream.progress
+        expired = self.refresh is not None and _is_expired(error)
+        if not (expired or _is_transient(error)) or progress.retries >= self.retries:
+            raise error
+        if expired:
+            return await self._refresh(stream)
+        progress.retries += 1
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**(progress.retries - 1)))
+        logger.warning(f'{stream.sid} {error.__class__.__name__}: {error}, '
+                       f'retry {progress.retries} of {self.retries} in {delay:.1f} s')
+        await asyncio.sleep(delay)
 
-def get_pending_tasks(loop=None):
-    tasks = []
-    for task in asyncio.Task.all_tasks(loop=loop):
-        if 'clipy/download' in str(task):
-            stacks = task.get_stack()
-            if stacks:
-                stream = stacks[0].f_locals.get('stream')
-                if stream:
-                    tasks.append(stream.filename)
-    return tasks
+    async def _refresh(self, stream):
+        task = self.refreshing.get(stream.sid)
+        if task is None:
+            stream.progress.retries += 1
+            logger.warning(f'{stream.sid} URL expired, resolving it again, '
+                           f'retry {stream.progress.retries} of {self.retries}')
+            task = asyncio.ensure_future(self.refresh(stream))
+            self.refreshing[stream.sid] = task
+            task.add_done_callback(lambda t: self.refreshing.pop(stream.sid, None))
+        stream.url = await asyncio.shield(task)
 
 
-async def get(stream, actives):
+async def get(stream, actives, session, segments=SEGMENTS, limiter=None, directory=DIRECTORY,
+              retry=None):
     """
-    Govern downloading with a Semaphore
+    Download the stream, how many run at once is up to the caller, see ``clipy.scheduler``
+
+    Failures of the first request, or of a stream read in one piece, start the download over,
+    resuming from the manifest if there is one; the stream stays active meanwhile so it can be
+    cancelled.
     """
-    async with semaphore:
-        return await _download(stream, actives)
+    retry = retry or RetryPolicy()
+    fresh = False
+    while True:
+        try:
+            return await _download(
+                stream, actives, session, segments, limiter, directory, fresh, retry)
+        except SourceChanged as e:
+            if fresh:
+                raise
+            logger.warning(f'{stream.sid} {e}, starting over')
+            fresh = True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            actives[stream.sid] = stream
+            try:
+                await retry.wait(stream, e)
+            finally:
+                active = actives.pop(stream.sid, None) is not None
+            if not active:
+                return False, stream.progress.bytesdone
 
 
-async def _download(stream, actives):
+async def _download(stream, actives, session, segments=SEGMENTS, limiter=None,
+                    directory=DIRECTORY, fresh=False, retry=None):
     """
     Request stream's url and read from response and write to disk
 
-    After every chunk is processed the stream's progress is updated.
+    The session is the application's shared client so the connection is taken from, and
+    returned to, its pool.  Streams of known length from servers that accept byte ranges are
+    fetched as one or more concurrent segments and can be resumed, other streams are read
+    over the one connection.  Reading pauses as long as the bandwidth ``limiter`` asks.
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.get(stream.url) as response:
-
-            total = int(response.headers.get('Content-Length', '0').strip())
-            chunk_size = 2**14
-            bytesdone = 0
-            offset = 0
-            mode = "wb"
-            t0 = time.time()
-
-            target_dir = 'videos'
-            os.makedirs(target_dir, exist_ok=True)
-            target_path = os.path.join(target_dir, stream.filename)
-            temp_path = f'{target_path}.clipy'
-            logger.info(f'{stream.sid} -> {temp_path}')
-
-            # Taken from from Pafy https://github.com/np1/pafy
-            if os.path.exists(temp_path):
-                filesize = os.stat(temp_path).st_size
-
-                if filesize < total:
-                    mode = "ab"
-                    bytesdone = offset = filesize
-                    headers = dict(Range='bytes={}-'.format(offset))
-                    logger.info(f'{stream.sid} exists, sending headers: {headers}')
-                    response = await session.get(stream.url, headers=headers)
-
-            complete = False
-
-            with open(temp_path, mode) as fd:
-                actives[stream.sid] = stream
-
-                while stream.sid in actives:
-                    chunk = await response.content.read(chunk_size)
-                    # length = len(chunk)
-                    # logger.debug(f'@@@ {stream.sid} chunk len {length}')
-                    if len(chunk) == 0:
-                        complete = True
-                        break
-                    fd.write(chunk)
-
-                    bytesdone += len(chunk)
-
-                    stream.progress.update(
-                        bytesdone=bytesdone,
-                        elapsed=time.time() - t0,
-                        offset=offset,
-                        total=total,
-                    )
-
-                active = stream.sid in actives
-                logger.debug(f'{stream.sid} finished, active? {active}')
-                if stream.sid in actives:
-                    del actives[stream.sid]
+    limiter = limiter or clipy.throttle.BandwidthLimiter()
+    retry = retry or RetryPolicy()
+    await clipy.writer.run(os.makedirs, directory, exist_ok=True)
+    target_path = os.path.join(directory, stream.filename)
+    temp_path = f'{target_path}.clipy'
+    logger.info(f'{stream.sid} -> {temp_path}')
+    counter = clipy.metrics.DOWNLOAD_BYTES.labels(
+        stream.agent or 'unknown', clipy.metrics.get_host(stream.url))
+
+    async with session.get(stream.url, timeout=retry.timeout) as response:
+        response.raise_for_status()
+        total = int(response.headers.get('Content-Length', '0').strip())
+        ranged = response.headers.get('Accept-Ranges', '').strip() == 'bytes'
+
+        if ranged and total:
+            manifest = await _get_manifest(stream, response, temp_path, total, segments, fresh)
+            complete, bytesdone = await _get_segmented(
+                stream, actives, session, limiter, retry, counter, response, temp_path, manifest)
+        else:
+            complete, bytesdone = await _get_sequential(
+                stream, actives, limiter, counter, response, temp_path, total)
 
     if complete:
-        os.rename(temp_path, target_path)
+        await clipy.writer.run(os.rename, temp_path, target_path)
+
+    return complete, bytesdone
+
+
+async def _get_manifest(stream, response, temp_path, total, count, fresh):
+    """
+    Return the manifest of the partial download to resume, or of a new one
+    """
+    path = f'{temp_path}.manifest'
+    etag = response.headers.get('ETag')
+    modified = response.headers.get('Last-Modified')
+
+    manifest = None if fresh else await clipy.writer.run(clipy.manifest.Manifest.load, path)
+    if manifest is not None:
+        if manifest.matches(stream.sid, total, etag, modified):
+            await clipy.writer.run(manifest.verify, temp_path)
+            logger.info(f'{stream.sid} resuming {manifest}')
+            return manifest
+        logger.warning(f'{stream.sid} source changed since {manifest}, starting over')
+
+    count = count if total >= count * MIN_SEGMENT else 1
+    segments = clipy.manifest.split(total, count)
+    manifest = clipy.manifest.Manifest(path, stream.sid, total, etag, modified, segments)
+    writer = clipy.writer.FileWriter(temp_path)
+    await writer.open(truncate=0, preallocate=total)
+    await writer.close()
+    await clipy.writer.run(manifest.save)
+    return manifest
+
+
+async def _get_sequential(stream, actives, limiter, counter, response, temp_path, total):
+    """
+    Read the whole stream in order over one connection
+
+    Without byte ranges, or a length to check them against, there is no resuming so the
+    stream is always read from the start.  After every chunk is processed the stream's progress
+    is updated.
+    """
+    bytesdone = 0
+    complete = False
+    progress = stream.progress
+    progress.start(total)
+
+    writer = clipy.writer.FileWriter(temp_path)
+    await writer.open(truncate=0, preallocate=total)
+    try:
+        actives[stream.sid] = stream
+
+        while stream.sid in actives:
+            chunk = await response.content.readany()
+            if len(chunk) == 0:
+                complete = True
+                break
+            await writer.write(chunk)
+
+            bytesdone += len(chunk)
+            progress.advance(len(chunk))
+            counter.inc(len(chunk))
+
+            delay = limiter.delay(stream.sid, len(chunk))
+            if delay:
+                await asyncio.sleep(delay)
+
+    finally:
+        response.release()
+        await writer.close(fsync=complete)
+        active = stream.sid in actives
+        logger.debug(f'{stream.sid} finished, active? {active}')
+        if stream.sid in actives:
+            del actives[stream.sid]
 
     return complete, bytesdone
+
+
+async def _get_segmented(stream, actives, session, limiter, retry, counter, response, temp_path,
+                         manifest):
+    """
+    Read the stream as concurrent byte ranges each written at its own offset
+
+    The manifest is saved next to the temp file as the segments progress so an interrupted
+    download resumes every segment where it left off.  The first response, which is for the
+    whole stream, is used for a segment still at the start and released at once otherwise, so
+    it does not hold a connection.  The stream's progress is the aggregate of all segments.
+    Each segment reconnects on its own after a transient failure.
+    """
+    segments = manifest.segments
+    stream.progress.start(manifest.total, manifest.done)
+
+    def is_active():
+        return stream.sid in actives
+
+    def throttle(length):
+        counter.inc(length)
+        return limiter.delay(stream.sid, length)
+
+    async def checkpoint():
+        # Only claim the bytes counted before the writers were flushed
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+            state = [s.copy() for s in segments]
+            await asyncio.gather(*(w.flush() for w in writers))
+            await clipy.writer.run(manifest.save, state)
+
+    pending = [s for s in segments if not s.complete]
+    if not pending or pending[0].position != 0:
+        response.release()
+    writers = [clipy.writer.FileWriter(temp_path) for s in pending]
+    for segment, writer in zip(pending, writers):
+        await writer.open(segment.position)
+
+    def get_segment(segment, writer):
+        first = response if segment.position == 0 else None
+        return _get_segment(
+            session, stream, manifest, segment, writer, is_active, throttle, retry, first)
+
+    logger.info(f'{stream.sid} fetching {len(pending)} of {len(segments)} segments')
+    actives[stream.sid] = stream
+    tasks = [asyncio.ensure_future(get_segment(s, w)) for s, w in zip(pending, writers)]
+    saver = asyncio.ensure_future(checkpoint())
+    try:
+        await asyncio.gather(*tasks)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        saver.cancel()
+        response.release()
+        complete = manifest.complete
+        await asyncio.gather(*(w.close(fsync=complete) for w in writers))
+        await clipy.writer.run(manifest.save)
+        active = stream.sid in actives
+        logger.debug(f'{stream.sid} finished, active? {active}')
+        if stream.sid in actives:
+            del actives[stream.sid]
+
+    if complete:
+        await clipy.writer.run(manifest.remove)
+
+    return complete, manifest.done
+
+
+async def _get_segment(session, stream, manifest, segment, writer, is_active, throttle, retry,
+                       response=None):
+    """
+    Read one byte range and write it in place
+
+    The range is requested only if the content is unchanged; any other content is refused.
+    After a transient failure the rest of the range is requested again from the byte after the
+    last one written.
+    """
+    while is_active() and not segment.complete:
+        try:
+            if response is None:
+                headers = dict(Range=f'bytes={segment.position}-{segment.end}')
+                if manifest.validator:
+                    headers['If-Range'] = manifest.validator
+                response = await session.get(stream.url, headers=headers, timeout=retry.timeout)
+                _check_range(response, segment.position, manifest.total)
+            await _read_segment(response, segment, writer, is_active, throttle, stream.progress)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await retry.wait(stream, e)
+        finally:
+            if response is not None:
+                response.release()
+                response = None
+
+
+async def _read_segment(response, segment, writer, is_active, throttle, progress):
+    while is_active() and not segment.complete:
+        chunk = await response.content.readany()
+        if len(chunk) == 0:
+            raise aiohttp.ClientPayloadError(f'Response ended before byte {segment.position}')
+        remaining = segment.length - segment.done
+        if len(chunk) > remaining:
+            chunk = chunk[:remaining]
+        await writer.write(chunk)
+        segment.update(chunk)
+        progress.advance(len(chunk))
+
+        delay = throttle(len(chunk))
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def _check_range(response, position, total):
+    """Make sure the response holds the requested range of the expected content
+    """
+    if response.status == 200:
+        raise SourceChanged(f'Got the whole content for bytes {position}-')
+    if response.status != 206:
+        response.raise_for_status()
+        raise ValueError(f'Range not honoured, got status {response.status}')
+
+    content_range = response.headers.get('Content-Range', '')
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', content_range)
+    if not match or int(match.group(1)) != position or match.group(2) not in ('*', str(total)):
+        raise SourceChanged(f'Got {content_range} for bytes {position}- of {total}')
+
+
+def _is_expired(error):
+    """Was the request refused because its signed URL has expired?"""
+    return isinstance(error, aiohttp.ClientResponseError) and error.status in EXPIRED
+
+
+def _is_transient(error):
+    """Might the request succeed if it is made again?"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (
+        aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError,
+        ConnectionError))
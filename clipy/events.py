@@ -0,0 +1,183 @@
+"""
+Clipy download progress events
+
+Browsers subscribe to a stream of events instead of polling ``/api/progress``.  Job state
+transitions are pushed as they happen, while byte progress is coalesced and pushed at most once
+per ``INTERVAL`` for the streams that moved since the previous push.  Clients that poll
+instead ask for what changed since the ``ProgressState`` version of their previous response.
+"""
+import time
+import asyncio
+import logging
+import collections
+
+import clipy.serial
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = 1  # Seconds between progress pushes
+BACKLOG = 64  # Events held for a subscriber before it is dropped as too slow
+HEARTBEAT = 15  # Seconds of quiet before a keep-alive comment is sent
+REMOVED = 1000  # Removed streams remembered for deltas
+
+
+class Subscriber():
+    """One connected client's queue of ``(event, data)`` pairs, ``None`` means close
+    """
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=BACKLOG)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def close(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class ProgressHub():
+    """Fan out download events to all subscribers
+
+    ``actives`` is the application's dictionary of streams currently transferring.
+    """
+    def __init__(self, actives, interval=INTERVAL):
+        self.actives = actives
+        self.interval = interval
+        self.subscribers = set()
+        self.sent = dict()
+        self.task = None
+
+    def __repr__(self):
+        return f'<ProgressHub {len(self.subscribers)} subscribers>'
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self.task = loop.create_task(self._tick())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        for subscriber in self.subscribers:
+            subscriber.close()
+        self.subscribers.clear()
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        logger.debug(f'subscribed, {self}')
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        logger.debug(f'unsubscribed, {self}')
+
+    def publish(self, event, data):
+        for subscriber in list(self.subscribers):
+            if not subscriber.put((event, data)):
+                logger.warning(f'dropping slow subscriber, {self}')
+                self.unsubscribe(subscriber)
+                subscriber.close()
+
+    def transition(self, job):
+        """Scheduler callback, push a job's new state right away"""
+        self.publish('transition', dict(
+            sid=job.sid,
+            vid=job.stream.vid,
+            filename=job.filename,
+            state=job.state,
+        ))
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.subscribers:
+                continue
+
+            changed = [
+                stream for sid, stream in self.actives.items()
+                if sid not in self.sent or self.sent[sid] != stream.progress.bytesdone
+            ]
+            self.sent = {sid: s.progress.bytesdone for sid, s in self.actives.items()}
+            if changed:
+                self.publish('progress', dict(actives=[s.serial() for s in changed]))
+
+
+class ProgressState():
+    """Version of the download registry, for conditional and delta progress responses
+
+    The actives, the pending filenames and the limits are compared with what they were when
+    ``update`` was last called, rather than every change being counted as it happens, so the
+    downloader pays nothing for it.  Versions start from the clock in milliseconds, so those
+    from before a restart are older than the current ones.
+    """
+    def __init__(self, actives, scheduler, size=REMOVED):
+        self.actives = actives
+        self.scheduler = scheduler
+        self.size = size
+        self.version = self.floor = int(time.time() * 1000)
+        self.stamps = dict()
+        self.removed = collections.OrderedDict()
+        self.pending = None
+        self.pending_version = self.version
+        self.limits = None
+
+    def __repr__(self):
+        return f'<ProgressState {self.version} {len(self.stamps)} streams>'
+
+    def update(self):
+        """Take in the changes since the last update and return the current version"""
+        version = self.version + 1
+        changed = False
+        for sid, stream in self.actives.items():
+            stamp = stream.progress.stamp
+            previous = self.stamps.get(sid)
+            if previous is None or previous[0] != stamp:
+                self.stamps[sid] = (stamp, version)
+                self.removed.pop(sid, None)
+                changed = True
+        for sid in [sid for sid in self.stamps if sid not in self.actives]:
+            del self.stamps[sid]
+            self.removed[sid] = version
+            changed = True
+        while len(self.removed) > self.size:
+            self.floor = self.removed.popitem(last=False)[1]
+
+        pending = self.scheduler.pending
+        if pending != self.pending:
+            self.pending = pending
+            self.pending_version = version
+            changed = True
+        limits = self.scheduler.limiter.serial()
+        if limits != self.limits:
+            self.limits = limits
+            changed = True
+
+        if changed:
+            self.version = version
+        return self.version
+
+    def delta(self, since):
+        """Return the sids changed and removed after version ``since``, or None if it is unknown
+        """
+        if not self.floor <= since <= self.version:
+            return None
+        changed = [sid for sid, (_, version) in self.stamps.items() if version > since]
+        removed = [sid for sid, version in self.removed.items() if version > since]
+        return changed, removed
+
+
+def format_event(event, data):
+    """Encode an event in the ``text/event-stream`` format
+
+    >>> format_event('transition', dict(state='queued'))
+    b'event: transition\\ndata: {"state":"queued"}\\n\\n'
+    """
+    return f'event: {event}\ndata: '.encode('utf-8') + clipy.serial.encode(data) + b'\n\n'
@@ -0,0 +1,160 @@
+"""
+Clipy partial download manifest
+
+A ``.manifest`` file next to each ``.clipy`` temp file records which stream the partial data is
+from, the server's validators for it, the byte ranges already on disk and a CRC-32 of every
+block written in each range.  A download only resumes when the server still has the same
+content, and only onto blocks that check out.
+"""
+import os
+import json
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 2**20  # Bytes covered by each checksum
+
+
+class Segment():
+    """Byte range ``start`` to ``end`` (inclusive) of a stream, of which ``done`` bytes are on disk
+
+    ``checksums`` holds the CRC-32 of each ``BLOCK`` of the range written so far.
+    """
+    def __init__(self, start, end, done=0, checksums=None):
+        self.start = start
+        self.end = end
+        self.done = done
+        self.checksums = list(checksums or ())
+        self.crc = 0
+
+    def __repr__(self):
+        return f'<Segment {self.start}-{self.end} done {self.done}>'
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+    @property
+    def position(self):
+        return self.start + self.done
+
+    @property
+    def complete(self):
+        return self.position > self.end
+
+    def update(self, data):
+        """Count ``data`` as done, adding to the rolling checksum of the current block"""
+        view = memoryview(data)
+        while view:
+            part = view[:BLOCK - self.done % BLOCK]
+            self.crc = zlib.crc32(part, self.crc)
+            self.done += len(part)
+            view = view[len(part):]
+            if self.done % BLOCK == 0 or self.complete:
+                self.checksums.append(self.crc)
+                self.crc = 0
+
+    def copy(self):
+        return Segment(self.start, self.end, self.done, self.checksums)
+
+    def verify(self, fd):
+        """Roll ``done`` back to the end of the last block whose checksum matches the file"""
+        while self.checksums:
+            index = len(self.checksums) - 1
+            offset = index * BLOCK
+            length = min(BLOCK, self.length - offset)
+            fd.seek(self.start + offset)
+            if zlib.crc32(fd.read(length)) == self.checksums[-1]:
+                self.done = offset + length
+                break
+            logger.warning(f'{self} block {index} is corrupt')
+            self.checksums.pop()
+        else:
+            self.done = 0
+        self.crc = 0
+
+
+class Manifest():
+    """Source identity, validators and progress of one partial download
+    """
+    def __init__(self, path, sid, total, etag=None, modified=None, segments=()):
+        self.path = path
+        self.sid = sid
+        self.total = total
+        self.etag = etag
+        self.modified = modified
+        self.segments = list(segments)
+
+    def __repr__(self):
+        return f'<Manifest {self.sid} {self.done}/{self.total}>'
+
+    @property
+    def done(self):
+        return sum(s.done for s in self.segments)
+
+    @property
+    def complete(self):
+        return all(s.complete for s in self.segments)
+
+    @property
+    def validator(self):
+        """The value for an ``If-Range`` header, a strong ETag or else the modification date"""
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.modified
+
+    def matches(self, sid, total, etag, modified):
+        """Is the partial download from the same content the server has now?"""
+        return (self.sid, self.total, self.etag, self.modified) == (sid, total, etag, modified)
+
+    def verify(self, temp_path):
+        """Check the last block of every segment against the temp file"""
+        done = self.done
+        with open(temp_path, 'rb') as fd:
+            for segment in self.segments:
+                segment.verify(fd)
+        if self.done < done:
+            logger.info(f'{self} dropped {done - self.done} unverified bytes')
+
+    def save(self, segments=None):
+        """Write the manifest, with ``segments`` in place of the live ones if given"""
+        state = dict(
+            sid=self.sid,
+            total=self.total,
+            etag=self.etag,
+            modified=self.modified,
+            segments=[
+                (s.start, s.end, s.done, s.checksums) for s in segments or self.segments
+            ],
+        )
+        with open(f'{self.path}.tmp', 'w') as fd:
+            json.dump(state, fd)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    @classmethod
+    def load(cls, path):
+        """Return the manifest saved at path, or None"""
+        try:
+            with open(path) as fd:
+                state = json.load(fd)
+            segments = [Segment(*s) for s in state.pop('segments')]
+            return cls(path, segments=segments, **state)
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            if os.path.exists(path):
+                logger.warning(f'Cannot load manifest {path}: {e}')
+            return None
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def split(total, count):
+    """Divide ``total`` bytes into ``count`` contiguous segments
+
+    >>> split(10, 3)
+    [<Segment 0-3 done 0>, <Segment 4-7 done 0>, <Segment 8-9 done 0>]
+    """
+    size = -(-total // count)
+    return [Segment(start, min(start + size, total) - 1) for start in range(0, total, size)]
@@ -0,0 +1,182 @@
+"""
+Clipy telemetry in the Prometheus text format
+
+Counters and histograms are updated where things happen; the downloader resolves its labelled
+counter once per download so counting a chunk is a single addition.  Gauges of the application
+state are set when the metrics are scraped, see ``clipy.views.metrics``.
+"""
+import math
+import urllib.parse
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, math.inf)
+
+
+class Value():
+    """The value of a metric for one set of labels"""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Buckets():
+    """The observations of a histogram for one set of labels"""
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.sum += value
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metric():
+    """A named metric with a value per combination of label values
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = dict()
+        (REGISTRY if registry is None else registry).append(self)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name} {len(self.values)} series>'
+
+    def labels(self, *values):
+        """Return the value for the label values, to update directly"""
+        child = self.values.get(values)
+        if child is None:
+            child = self.values[values] = self._new()
+        return child
+
+    def clear(self):
+        self.values.clear()
+
+    def _new(self):
+        return Value()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self.values.items()):
+            lines.extend(self._render(values, child))
+        return lines
+
+    def _render(self, values, child):
+        yield f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS, registry=None):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _new(self):
+        return Buckets(self.buckets)
+
+    def _render(self, values, child):
+        count = 0
+        for bound, n in zip(child.bounds, child.counts):
+            count += n
+            le = '+Inf' if bound == math.inf else _format_value(bound)
+            labels = _format_labels(self.labelnames + ('le',), values + (le,))
+            yield f'{self.name}_bucket{labels} {count}'
+        labels = _format_labels(self.labelnames, values)
+        yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+        yield f'{self.name}_count{labels} {count}'
+
+
+REGISTRY = list()
+
+DOWNLOAD_BYTES = Counter(
+    'clipy_download_bytes_total', 'Bytes downloaded', ('agent', 'host'))
+JOBS = Gauge(
+    'clipy_jobs', 'Download jobs by state', ('state',))
+JOB_RATE = Gauge(
+    'clipy_job_rate_bytes', 'Throughput of each running download in bytes per second', ('sid',))
+RATE = Gauge(
+    'clipy_download_rate_bytes', 'Throughput of all downloads in bytes per second')
+UPSTREAM_SECONDS = Histogram(
+    'clipy_upstream_request_seconds', 'Latency of upstream metadata requests, failed or not',
+    ('host', 'outcome'))
+HTTP_SECONDS = Histogram(
+    'clipy_http_request_seconds', 'Latency of API handlers', ('route', 'method'))
+ERRORS = Counter(
+    'clipy_errors_total', 'Errors raised by handlers', ('exception',))
+LOOP_LAG = Histogram(
+    'clipy_loop_lag_seconds', 'Delay of the event loop waking a sleeping task')
+SLOW_CALLBACKS = Histogram(
+    'clipy_slow_callback_seconds', 'Callbacks that held the event loop, when reported')
+
+
+def render(registry=None):
+    """Return the metrics as text for a Prometheus scrape"""
+    lines = list()
+    for metric in REGISTRY if registry is None else registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def get_host(url):
+    """The domain of the url's host, so the many servers of a CDN are one label value
+
+    >>> get_host('https://r4---sn-ab5l6nzr.googlevideo.com/videoplayback?id=1')
+    'googlevideo.com'
+    >>> get_host('http://127.0.0.1:8080/video')
+    '127.0.0.1'
+    """
+    host = urllib.parse.urlsplit(url).hostname or ''
+    if host.replace('.', '').isdigit() or ':' in host:
+        return host
+    return '.'.join(host.split('.')[-2:])
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
@@ -1,6 +1,9 @@
+import sys
 import string
 import logging
 
+import clipy.progress
+import clipy.serial
 import clipy.utils
 
 from clipy.utils import take_first as tf
@@ -10,105 +13,183 @@ logger = logging.getLogger(__name__)
 
 class Model():
     """Base model
+
+    ``to_json`` keeps the encoding of ``fields``, which is dropped whenever a public attribute
+    is set, and adds the encoding of the fields that change all the time from ``_encode_live``.
     """
+    __slots__ = ('_json',)
+
     def __repr__(self):
         return '\n\n'.join(clipy.utils.list_properties(self))
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != '_':
+            object.__setattr__(self, '_json', None)
+
     def detail(self):
         return clipy.utils.dict_properties(self)
 
+    def fields(self):
+        return dict()
+
+    def to_json(self):
+        """Return the model encoded as in ``serial``"""
+        if self._json is None:
+            self._json = clipy.serial.encode(self.fields())
+        live = self._encode_live()
+        if not live:
+            return clipy.serial.Raw(self._json)
+        return clipy.serial.Raw(self._json[:-1] + b',' + live + b'}')
+
+    def _encode_live(self):
+        return b''
+
 
 class VideoModel(Model):
     """Video information container
+
+    ``info`` is the upstream information the agent needs to make the video's streams, trimmed
+    by the agent to what it uses; the fields shown to the user are kept as attributes.  The agent
+    may keep an index of the streams in the info in ``stream_index`` so it is built only once.
     """
-    def __init__(self, vid, info) -> None:
+    __slots__ = (
+        'vid', 'title', 'author', 'duration', 'description', 'thumbnail', 'info', 'stream',
+        'streams', 'stream_index',
+    )
+
+    def __init__(self, vid, info, title=None, author=None, duration=None, description=None,
+                 thumbnail=None) -> None:
         self.vid = vid
         self.info = info
+        self.title = title or info.get('title')
+        self.author = author
+        self.duration = duration
+        self.description = description
+        self.thumbnail = thumbnail
         self.stream = None
         self.streams = list()
-        self.info_map = dict()
-
-    def __getattr__(self, field_name):
-        """Check if our attribute exists for the object, otherwise return the corresponding entry
-        from our 'info'.
-        """
-        return self.__dict__.get(
-            field_name,
-            self.info.get(
-                self.info_map.get(field_name, field_name)))
+        self.stream_index = None
 
     def __str__(self):
         return '<{cls}> {duration} {title}'.format(
             cls=self.__class__.__name__, duration=self.duration, title=self.title)
 
-    def serial(self):
-        data = dict(self.__dict__)
-        data.update(self.info)
-        data.update(
-            # Object of type 'StreamModel' is not JSON serializable
-            streams=[s.serial() for s in self.streams],
+    def fields(self):
+        return dict(
+            vid=self.vid,
+            title=self.title,
+            author=self.author,
+            duration=self.duration,
+            description=self.description,
+            thumbnail=self.thumbnail,
         )
-        return data
+
+    def serial(self):
+        return dict(self.fields(), streams=[s.serial() for s in self.streams])
+
+    def _encode_live(self):
+        return b'"streams":' + clipy.serial.array(s.to_json() for s in self.streams)
 
 
 class StreamModel(Model):
     """Video stream
+
+    Only the fields in ``FIELDS`` are taken from the info; the values of ``INTERNED`` repeat
+    across many streams and are interned so they are stored once.
     """
+    FIELDS = ('display', 'filename', 'title', 'url', 'itag', 'type', 'quality')
+    INTERNED = ('itag', 'type', 'quality')
+
+    __slots__ = (
+        'progress', 'agent', 'index', 'sid', 'vid', 'name', 'downloaded', '_live', '_stamp',
+    ) + FIELDS
+
     def __init__(self, info, video, index):
         """  """
-        # Initialize some main properties
-        self.progress = dict()
-        self.display = str(index)
+        self.progress = clipy.progress.Progress()
+        self._stamp = None
+        self.agent = None
+        self.downloaded = False
         self.index = index
-        self.name = video.name or video.title
-        self.type = None
         self.sid = f'{video.vid}|{index}'
         self.vid = video.vid
-        self.url = None
-        self.user = None
-
-        # Load all info items into the object namespace
-        for k, v in info.items():
-            setattr(self, k, tf(v))
+        self.name = video.title
+        for field in self.FIELDS:
+            value = tf(info.get(field))
+            if field in self.INTERNED and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, field, value)
+        self.display = self.display or str(index)
 
         logger.debug(f'Stream {index} {self.name}')
 
     def __str__(self):
         return f'display: {self.display}, status: {self.status}'
 
+    @classmethod
+    def restore(cls, data):
+        """Make a stream again from its ``fields``"""
+        video = VideoModel(data['vid'], dict(), title=data['name'])
+        stream = cls(data, video, data['index'])
+        stream.agent = data['agent']
+        return stream
+
+    @property
+    def key(self):
+        """Identity of the stream's content, the same whatever its index or filename"""
+        return f'{self.vid}|{self.itag or self.type or self.index}'
+
+    def fields(self):
+        return dict(
+            agent=self.agent,
+            index=self.index,
+            sid=self.sid,
+            vid=self.vid,
+            name=self.name,
+            downloaded=self.downloaded,
+            **{field: getattr(self, field) for field in self.FIELDS}
+        )
+
     def serial(self):
-        data = dict(self.__dict__)
-        data.update(status=self.status)
-        return data
+        return dict(
+            self.fields(),
+            progress=self.progress.serial(),
+            status=self.status,
+        )
+
+    def _encode_live(self):
+        # Reencoded only when the progress has moved, so idle streams cost nothing
+        stamp = self.progress.stamp
+        if self._stamp != stamp:
+            self._stamp = stamp
+            self._live = (b'"progress":' + clipy.serial.dumps(self.progress.serial()) +
+                          b',"status":' + clipy.serial.dumps(self.status))
+        return self._live
 
     @property
     def status(self):
-        bytesdone = int(self.progress.get('bytesdone', 0))
-        total = int(self.progress.get('total', 0))
+        progress = self.progress
 
-        return '{d:,} ({p:.0%}) {t} @ {r:.0f} KB/s {e:.0f} s'.format(
-            d=bytesdone,
-            t=clipy.utils.size(total),
-            p=(bytesdone * 1.0 / total) if total else 0.0,
+        status = '{d:,} ({p:.0%}) {t} @ {r:.0f} KB/s {e:.0f} s'.format(
+            d=progress.bytesdone,
+            t=clipy.utils.size(progress.total),
+            p=progress.fraction,
             r=self.rate,
             e=self.eta,
         )
+        if progress.retries:
+            status += f' ({progress.retries} retries)'
+        return status
 
     @property
     def rate(self):
-        bytesdone = int(self.progress.get('bytesdone', 0))
-        elapsed = int(self.progress.get('elapsed', 0))
-        offset = int(self.progress.get('offset', 0))
-
-        return (((bytesdone - offset) / 1024) / elapsed) if elapsed else 0.0
+        """Current throughput in KB/s"""
+        return self.progress.rate / 1024
 
     @property
     def eta(self):
-        bytesdone = int(self.progress.get('bytesdone', 0))
-        total = int(self.progress.get('total', 0))
-        rate = self.rate
-
-        return (total - bytesdone) / (rate * 1024) if rate else 0.0
+        return self.progress.eta
 
     @staticmethod
     def safe_name(name: str):
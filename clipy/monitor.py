@@ -0,0 +1,200 @@
+"""
+Clipy runtime monitoring
+
+A background task sleeps for ``INTERVAL`` over and over and measures how late the event loop
+wakes it.  That lag is how long callbacks and coroutines hold the loop without yielding, which
+delays every download and request the server is handling.  To find out what holds it, slow
+callbacks can be reported and the running server can be profiled for a few seconds at a time.
+"""
+import os
+import sys
+import time
+import marshal
+import asyncio
+import cProfile
+import logging
+import threading
+import contextlib
+import collections
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = 0.1  # Seconds between lag samples
+SLOW = 0.1  # Seconds a callback may hold the loop before it is reported
+RECENT = 20  # Slow callbacks kept for display
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+MAX_PROFILE = 60  # Most seconds one profile may take
+
+_profiling = False
+
+
+class LagMonitor():
+    """Sample the event loop's lag in the background
+
+    ``lag`` is the latest sample and ``peak`` the largest; callables in ``on_sample`` are called
+    with every sample in seconds.
+    """
+    def __init__(self, interval=INTERVAL, loop=None):
+        self.interval = interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.lag = 0.0
+        self.peak = 0.0
+        self.samples = 0
+        self.task = None
+        self.on_sample = list()
+
+    def __repr__(self):
+        return f'<LagMonitor {self.lag * 1000:.1f} ms, peak {self.peak * 1000:.1f} ms>'
+
+    def start(self):
+        if self.task is None:
+            self.task = self.loop.create_task(self._run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.wait([self.task])
+            self.task = None
+
+    async def _run(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, self.loop.time() - start - self.interval)
+            self.lag = lag
+            self.peak = max(self.peak, lag)
+            self.samples += 1
+            for callback in self.on_sample:
+                callback(lag)
+
+
+class SlowCallbackMonitor():
+    """Report callbacks that hold the event loop for ``threshold`` seconds or more
+
+    This is the loop's debug mode ``slow_callback_duration`` without the rest of debug mode's
+    cost: while enabled ``asyncio.Handle._run`` is wrapped to time every callback.  The last
+    ``RECENT`` slow callbacks are kept and callables in ``on_slow`` are called with the seconds
+    each took.  Loops that run their own handles, such as uvloop, are not covered.
+    """
+    def __init__(self, threshold=SLOW, size=RECENT):
+        self.threshold = threshold
+        self.recent = collections.deque(maxlen=size)
+        self.count = 0
+        self.on_slow = list()
+        self._run = None
+
+    def __repr__(self):
+        state = f'over {self.threshold} s' if self.enabled else 'disabled'
+        return f'<SlowCallbackMonitor {state}, {self.count} slow>'
+
+    @property
+    def enabled(self):
+        return self._run is not None
+
+    def enable(self, threshold=None):
+        self.threshold = threshold or self.threshold
+        if self._run is not None:
+            return
+
+        run = self._run = asyncio.events.Handle._run
+        clock = time.monotonic
+
+        def timed_run(handle):
+            start = clock()
+            run(handle)
+            duration = clock() - start
+            if duration >= self.threshold:
+                self._report(handle, duration)
+
+        asyncio.events.Handle._run = timed_run
+        logger.info(f'enabled {self}')
+
+    def disable(self):
+        if self._run is not None:
+            asyncio.events.Handle._run = self._run
+            self._run = None
+            logger.info(f'disabled {self}')
+
+    def serial(self):
+        return dict(
+            enabled=self.enabled,
+            threshold=self.threshold,
+            count=self.count,
+            recent=list(self.recent),
+        )
+
+    def _report(self, handle, duration):
+        callback = _format_handle(handle)
+        self.count += 1
+        self.recent.append(dict(time=time.time(), callback=callback, seconds=duration))
+        logger.warning(f'Executing {callback} took {duration:.3f} seconds')
+        for on_slow in self.on_slow:
+            on_slow(duration)
+
+
+async def profile(seconds):
+    """Profile what the event loop runs for ``seconds`` and return the stats as pstats data
+
+    The data is what ``pstats.Stats.dump_stats`` writes; the writer threads are not profiled.
+    """
+    with _exclusive():
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        profiler.create_stats()
+        return marshal.dumps(profiler.stats)
+
+
+async def sample(seconds, interval=SAMPLE_INTERVAL):
+    """Sample the event loop thread's stack every ``interval`` for ``seconds``
+
+    Returns the stacks collapsed one per line with the times each was seen, the input format of
+    flame graph tools.  The sampler runs in its own thread so it sees what blocks the loop.
+    """
+    with _exclusive():
+        ident = threading.get_ident()
+        stacks = collections.Counter()
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                frame = sys._current_frames().get(ident)
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    stack.append(f'{code.co_name} ({filename}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+
+        thread = threading.Thread(target=run, name='clipy-sampler', daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            thread.join()
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()).encode()
+
+
+@contextlib.contextmanager
+def _exclusive():
+    global _profiling
+    if _profiling:
+        raise RuntimeError('A profile is already being taken')
+    _profiling = True
+    try:
+        yield
+    finally:
+        _profiling = False
+
+
+def _format_handle(handle):
+    # A task's step is shown as the task, which names its coroutine
+    owner = getattr(handle._callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        return repr(owner)
+    return repr(handle)
@@ -0,0 +1,116 @@
+"""
+Clipy download progress tracking
+
+The downloader calls ``Progress.advance`` for every chunk so it only adds to a counter and
+reads the clock; the rate is recalculated at most once per ``INTERVAL``.  The rate is an
+exponentially weighted moving average so the ETA follows the current throughput rather than
+the average since the start, and the last ``SAMPLES`` rates are kept for display.  Reading the
+rate of an unfinished transfer also takes a sample once an interval has passed, so the rate of
+a stalled download falls towards zero instead of keeping its last value.
+"""
+import math
+import time
+
+INTERVAL = 0.5  # Seconds between rate samples
+WINDOW = 5.0  # Seconds, time constant of the moving average
+SAMPLES = 30  # Recent rate samples kept
+
+_clock = time.monotonic
+
+
+class Progress():
+    """Bytes done out of total for one stream, with throughput in bytes per second
+
+    ``retries`` counts the reconnections of the whole download, ``start`` leaves it alone.
+    """
+    __slots__ = (
+        'bytesdone', 'total', 'offset', 'elapsed', 'samples', 'retries', '_rate',
+        '_started', '_last', '_last_bytes', '_cursor',
+    )
+
+    def __init__(self):
+        self.bytesdone = 0
+        self.total = 0
+        self.offset = 0
+        self.elapsed = 0.0
+        self._rate = 0.0
+        self.samples = [0.0] * SAMPLES
+        self.retries = 0
+        self._started = self._last = _clock()
+        self._last_bytes = 0
+        self._cursor = 0
+
+    def __repr__(self):
+        return f'<Progress {self.bytesdone}/{self.total} @ {self._rate:.0f} B/s>'
+
+    def start(self, total, offset=0):
+        """Begin a transfer of ``total`` bytes of which ``offset`` are already done"""
+        self.total = total
+        self.offset = self.bytesdone = self._last_bytes = offset
+        self.elapsed = self._rate = 0.0
+        self._started = self._last = _clock()
+
+    def advance(self, length):
+        """Count ``length`` more bytes done, sampling the rate when an interval has passed"""
+        self.bytesdone += length
+        now = _clock()
+        if now - self._last >= INTERVAL:
+            self._sample(now)
+
+    def _sample(self, now):
+        span = now - self._last
+        rate = (self.bytesdone - self._last_bytes) / span
+        if self._rate:
+            self._rate += (rate - self._rate) * (1.0 - math.exp(-span / WINDOW))
+        else:
+            self._rate = rate
+        self.samples[self._cursor] = rate
+        self._cursor = (self._cursor + 1) % SAMPLES
+        self._last = now
+        self._last_bytes = self.bytesdone
+        self.elapsed = now - self._started
+
+    def _refresh(self):
+        # Sample a transfer that is waiting for data so its rate does not stay stale
+        if self.bytesdone < self.total:
+            now = _clock()
+            if now - self._last >= INTERVAL:
+                self._sample(now)
+
+    @property
+    def rate(self):
+        """Bytes per second, moving average"""
+        self._refresh()
+        return self._rate
+
+    @property
+    def stamp(self):
+        """Changes whenever ``serial`` would"""
+        self._refresh()
+        return (self.bytesdone, self.total, self.retries, self._last)
+
+    @property
+    def fraction(self):
+        return self.bytesdone / self.total if self.total else 0.0
+
+    @property
+    def eta(self):
+        """Seconds remaining at the current rate"""
+        rate = self.rate
+        return (self.total - self.bytesdone) / rate if rate else 0.0
+
+    def history(self):
+        """Recent rate samples, oldest first"""
+        return self.samples[self._cursor:] + self.samples[:self._cursor]
+
+    def serial(self):
+        return dict(
+            bytesdone=self.bytesdone,
+            total=self.total,
+            offset=self.offset,
+            elapsed=self.elapsed,
+            rate=self.rate,
+            eta=self.eta,
+            samples=self.history(),
+            retries=self.retries,
+        )
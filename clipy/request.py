@@ -1,18 +1,70 @@
+"""
+Clipy upstream HTTP client
+
+All upstream traffic, inquiries and downloads alike, goes through one pooled session owned by
+the application so connections, TLS sessions and DNS lookups are reused across requests.
+"""
+import time
+import asyncio
 import logging
+import contextlib
 
 import aiohttp
 
+import clipy.metrics
+
 logger = logging.getLogger(__name__)
 
+LIMIT = 100  # Simultaneous connections in total
+LIMIT_PER_HOST = 8  # Simultaneous connections to any one host
+DNS_TTL = 300  # Seconds to cache resolved host addresses
+KEEPALIVE = 30  # Seconds to keep an idle connection open for reuse
+
+
+def create_session(limit=LIMIT, limit_per_host=LIMIT_PER_HOST, dns_ttl=DNS_TTL,
+                   keepalive=KEEPALIVE, headers=None):
+    """Return a new client session backed by a shared keep-alive connector
 
-async def get_text(url, headers=None):
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(url) as response:
+    Must be called from a coroutine, see ``clipy.server.on_startup``; the caller owns the
+    session and is responsible for closing it.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=dns_ttl,
+        keepalive_timeout=keepalive,
+    )
+    logger.debug(f'client session: limit {limit}, per host {limit_per_host}, dns ttl {dns_ttl}')
+    return aiohttp.ClientSession(connector=connector, headers=headers)
+
+
+async def get_text(session, url, headers=None):
+    with _observe(url):
+        async with session.get(url, headers=headers) as response:
             body = await response.read()
-            return body.decode('utf-8')
+    return body.decode('utf-8')
+
+
+async def get_json(session, url, headers=None):
+    with _observe(url):
+        async with session.get(url, headers=headers) as response:
+            data = await response.json()
+    return data
 
 
-async def get_json(url, headers=None):
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
+@contextlib.contextmanager
+def _observe(url):
+    """Time a request, by its host and whether it ended ``ok``, in a ``timeout`` or ``error``"""
+    outcome = 'error'
+    start = time.monotonic()
+    try:
+        yield
+        outcome = 'ok'
+    except asyncio.TimeoutError:
+        outcome = 'timeout'
+        raise
+    finally:
+        latency = time.monotonic() - start
+        clipy.metrics.UPSTREAM_SECONDS.labels(
+            clipy.metrics.get_host(url), outcome).observe(latency)
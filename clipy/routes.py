@@ -1,10 +1,21 @@
-from clipy.views import index, inquire, download, progress, cancel, shutdown
+from clipy.views import (
+    index, inquire, inquire_batch, download, download_list, progress, events, metrics, limits,
+    cancel, move, monitor, profile, shutdown,
+)
 
 
 def setup_routes(app):
     app.router.add_get('/', index)
     app.router.add_get('/api/inquire', inquire)
+    app.router.add_post('/api/inquire', inquire_batch)
     app.router.add_get('/api/download', download)
+    app.router.add_get('/api/download/list', download_list)
     app.router.add_get('/api/progress', progress)
+    app.router.add_get('/api/events', events)
+    app.router.add_get('/api/metrics', metrics)
+    app.router.add_get('/api/limits', limits)
     app.router.add_get('/api/cancel', cancel)
+    app.router.add_get('/api/move', move)
+    app.router.add_get('/api/monitor', monitor)
+    app.router.add_get('/api/profile', profile)
     app.router.add_get('/api/shutdown', shutdown)
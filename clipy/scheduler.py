@@ -0,0 +1,258 @@
+"""
+Clipy download job scheduler
+
+Downloads are queued as jobs and started in order as running jobs finish.  Jobs are indexed by
+stream ``sid``, by the stream's ``key`` and by filename so the views can ask whether a stream is
+already tasked without looking at the event loop's tasks.  A request for a stream that is
+already tasked gets the existing job, and one for a file already downloaded, as recorded in the
+``clipy.catalog.Catalog`` if there is one, a finished job.  A job's file is added to the catalog
+after the job has finished, so reading it for the checksum does not hold up the queue.  A
+running job that has had no data for the retry policy's ``stall`` seconds is ``stalled`` until
+its data flows again.
+"""
+import os
+import asyncio
+import collections
+import logging
+
+import clipy.download
+import clipy.throttle
+
+logger = logging.getLogger(__name__)
+
+CONCURRENCY = 3  # Number of downloads running at once
+
+
+class Job():
+    """A stream's download, queued or running
+
+    ``done`` is resolved with the final state when the job ends.
+    """
+    def __init__(self, stream, loop=None, state='queued'):
+        self.stream = stream
+        self.state = state
+        self.task = None
+        self.done = (loop or asyncio.get_event_loop()).create_future()
+        if state == 'finished':
+            self.done.set_result(state)
+
+    def __repr__(self):
+        return f'<Job {self.state} {self.sid}>'
+
+    @property
+    def sid(self):
+        return self.stream.sid
+
+    @property
+    def key(self):
+        return self.stream.key
+
+    @property
+    def filename(self):
+        return self.stream.filename
+
+    async def wait(self):
+        """Wait for the job to end and return its final state"""
+        return await asyncio.shield(self.done)
+
+
+class DownloadScheduler():
+    """Run download jobs from an explicit queue with bounded concurrency
+
+    ``actives`` is the application's dictionary of streams currently transferring, which the
+    downloader maintains and which ``cancel`` uses to stop a running transfer; a running job not
+    transferring yet has its task cancelled instead.  Callables in ``on_transition`` are called
+    with the job whenever a job changes state.
+    """
+    def __init__(self, actives, session, concurrency=CONCURRENCY, limiter=None, loop=None,
+                 segments=clipy.download.SEGMENTS, directory=clipy.download.DIRECTORY,
+                 catalog=None, retry=None):
+        self.actives = actives
+        self.session = session
+        self.concurrency = concurrency
+        self.segments = segments
+        self.directory = directory
+        self.catalog = catalog
+        self.retry = retry or clipy.download.RetryPolicy()
+        self.limiter = limiter or clipy.throttle.BandwidthLimiter()
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = collections.deque()
+        self.running = dict()
+        self.jobs = dict()
+        self.keys = dict()
+        self.filenames = dict()
+        self.recording = dict()
+        self.on_transition = list()
+
+    def __repr__(self):
+        return f'<DownloadScheduler {len(self.running)} running {len(self.queue)} queued>'
+
+    @property
+    def pending(self):
+        """Filenames of all jobs queued or running"""
+        return list(self.filenames)
+
+    def get(self, sid):
+        return self.jobs.get(sid)
+
+    def find(self, stream):
+        """Return the job of the same stream, or to the same file, queued or running, or None"""
+        return self.keys.get(stream.key) or self.filenames.get(stream.filename)
+
+    def is_tasked(self, filename):
+        return filename in self.filenames
+
+    def is_downloaded(self, stream):
+        if self.catalog is not None:
+            return stream.key in self.recording or self.catalog.find(stream) is not None
+        return os.path.exists(os.path.join(self.directory, stream.filename))
+
+    def is_queued(self, sid):
+        job = self.jobs.get(sid)
+        return job is not None and job.state == 'queued'
+
+    def is_running(self, sid):
+        return sid in self.running
+
+    def submit(self, stream, front=False):
+        """Queue the stream for download and return its job
+
+        If the stream or its file is already tasked the existing job is returned instead, and if
+        the file is already downloaded a finished job that is not queued.
+        """
+        job = self.find(stream)
+        if job is not None:
+            logger.debug(f'{stream.sid} attached to {job}')
+            return job
+        if self.is_downloaded(stream):
+            logger.debug(f'{stream.sid} already downloaded')
+            return Job(stream, self.loop, state='finished')
+
+        job = Job(stream, self.loop)
+        self.jobs[job.sid] = job
+        self.keys[job.key] = job
+        self.filenames[job.filename] = job
+        if front:
+            self.queue.appendleft(job)
+        else:
+            self.queue.append(job)
+        logger.debug(f'{job} submitted, {self}')
+        self._notify(job)
+        self._start()
+        return job
+
+    def move(self, sid, front=True):
+        """Move a queued job to the front or the back of the queue"""
+        job = self.jobs.get(sid)
+        if job is None or job.state != 'queued':
+            return False
+
+        self.queue.remove(job)
+        if front:
+            self.queue.appendleft(job)
+        else:
+            self.queue.append(job)
+        return True
+
+    def cancel(self, sid):
+        """Remove a queued job, or stop a running one leaving its partial file to resume later"""
+        job = self.jobs.get(sid)
+        if job is None:
+            return False
+
+        if job.state == 'queued':
+            self.queue.remove(job)
+            self._finish(job, 'cancelled')
+        elif sid in self.actives:
+            del self.actives[sid]
+        else:
+            # not transferring yet, still connecting or preparing its file
+            job.task.cancel()
+        return True
+
+    async def close(self):
+        """Drop all queued jobs, cancel the running ones and wait for the catalog to be updated
+        """
+        for job in list(self.queue):
+            self._finish(job, 'cancelled')
+        self.queue.clear()
+
+        tasks = [job.task for job in self.running.values()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        if self.recording:
+            await asyncio.wait(list(self.recording.values()))
+
+    def _start(self):
+        while self.queue and len(self.running) < self.concurrency:
+            job = self.queue.popleft()
+            job.state = 'running'
+            self.running[job.sid] = job
+            job.task = self.loop.create_task(self._run(job))
+            self._notify(job)
+
+    async def _run(self, job):
+        state = 'failed'
+        watcher = self.loop.create_task(self._watch(job))
+        try:
+            complete, bytesdone = await clipy.download.get(
+                job.stream, self.actives, self.session, self.segments, self.limiter,
+                self.directory, self.retry)
+            state = 'finished' if complete else 'cancelled'
+        except asyncio.CancelledError:
+            state = 'cancelled'
+            raise
+        except Exception as e:
+            logger.error(f'{job} {e.__class__.__name__}: {e}')
+        finally:
+            watcher.cancel()
+            del self.running[job.sid]
+            if state == 'finished' and self.catalog is not None:
+                self.recording[job.key] = self.loop.create_task(self._record(job))
+            self._finish(job, state)
+            self._start()
+
+    async def _record(self, job):
+        """Add the finished job's file to the catalog, which reads it all for the checksum"""
+        try:
+            await self.catalog.add(job.stream)
+        except Exception as e:
+            logger.error(f'{job} not catalogued, {e.__class__.__name__}: {e}')
+        finally:
+            del self.recording[job.key]
+
+    async def _watch(self, job):
+        """Move the job between running and stalled as its data stops and flows again"""
+        progress = job.stream.progress
+        bytesdone = progress.bytesdone
+        since = self.loop.time()
+        while True:
+            await asyncio.sleep(min(1.0, self.retry.stall / 2))
+            now = self.loop.time()
+            if progress.bytesdone != bytesdone:
+                bytesdone = progress.bytesdone
+                since = now
+                if job.state == 'stalled':
+                    job.state = 'running'
+                    self._notify(job)
+            elif job.state == 'running' and now - since >= self.retry.stall:
+                job.state = 'stalled'
+                logger.warning(f'{job} no data for {now - since:.1f} s')
+                self._notify(job)
+
+    def _finish(self, job, state):
+        job.state = state
+        del self.jobs[job.sid]
+        del self.keys[job.key]
+        del self.filenames[job.filename]
+        if not job.done.done():
+            job.done.set_result(state)
+        self.limiter.forget(job.sid)
+        logger.info(f'{job}, {self}')
+        self._notify(job)
+
+    def _notify(self, job):
+        for callback in self.on_transition:
+            callback(job)
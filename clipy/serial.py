@@ -0,0 +1,57 @@
+"""
+Clipy JSON encoding
+
+Responses are encoded to bytes with orjson when it is installed and the standard library
+otherwise.  Models keep the encoding of their fields that seldom change, see
+``clipy.models.Model.to_json``, and those bytes are spliced into responses as ``Raw`` values
+rather than being decoded and encoded again.
+"""
+import json
+
+import aiohttp.web
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CONTENT_TYPE = 'application/json'
+
+
+class Raw(bytes):
+    """Bytes that are already encoded JSON"""
+    __slots__ = ()
+
+
+if orjson is not None:
+    def dumps(data):
+        """Encode data as compact JSON bytes"""
+        return orjson.dumps(data)
+else:
+    def dumps(data):
+        """Encode data as compact JSON bytes"""
+        return json.dumps(data, separators=(',', ':')).encode()
+
+
+def encode(data):
+    """Encode a dictionary whose values may be ``Raw``
+
+    >>> encode(dict(rate=0, actives=array([Raw(b'{"sid":"a|0"}')])))
+    b'{"rate":0,"actives":[{"sid":"a|0"}]}'
+    """
+    return b'{' + b','.join(
+        dumps(key) + b':' + (value if isinstance(value, Raw) else dumps(value))
+        for key, value in data.items()
+    ) + b'}'
+
+
+def array(items):
+    """Join encoded items into an encoded list"""
+    return Raw(b'[' + b','.join(items) + b']')
+
+
+def json_response(data, status=200, headers=None):
+    """Return a JSON response of data, a dictionary or else already encoded bytes"""
+    body = data if isinstance(data, bytes) else encode(data)
+    return aiohttp.web.Response(body=body, status=status, headers=headers,
+                                content_type=CONTENT_TYPE)
@@ -1,13 +1,15 @@
 """
 https://docs.python.org/3/library/asyncio-dev.html#asyncio-debug-mode
 
-Enable the asyncio debug mode globally by setting the environment variable PYTHONASYNCIODEBUG to 1, or by calling AbstractEventLoop.set_debug().
+Debug mode is off by default as it slows everything down.  Enable the asyncio debug mode globally by setting the environment variable PYTHONASYNCIODEBUG to 1.
 
-Set the log level of the asyncio logger to logging.DEBUG. For example, call logging.basicConfig(level=logging.DEBUG) at startup.
+To find what blocks the loop without debug mode, report slow callbacks with ``/api/monitor?slow=0.05`` or take a profile with ``/api/profile?seconds=10``, see ``clipy.monitor``.
 
 Configure the warnings module to display ResourceWarning warnings. For example, use the -Wdefault command line option of Python to display them.
     python -Wdefault -m clipy.server
 """
+import os
+import time
 import asyncio
 import logging
 # import logging.config
@@ -17,10 +19,19 @@ import aiohttp_jinja2
 import jinja2
 # import yaml
 
+import clipy.agents.utils
+import clipy.cache
+import clipy.catalog
+import clipy.config
+import clipy.download
+import clipy.events
+import clipy.metrics
+import clipy.monitor
+import clipy.request
 import clipy.routes
-
-loop = asyncio.get_event_loop()
-loop.set_debug(True)
+import clipy.scheduler
+import clipy.store
+import clipy.throttle
 
 
 class PollFilter(logging.Filter):
@@ -32,20 +43,27 @@ class PollFilter(logging.Filter):
 #     config = yaml.load(stream)
 #     logging.config.dictConfig(config['logging'])
 
-logging.basicConfig(level=logging.DEBUG)
-
-asyncio_logger = logging.getLogger('asyncio')
-asyncio_logger.setLevel(logging.INFO)
-asyncio_logger.addFilter(PollFilter())
-
 # downloader_logger = logging.getLogger('clipy:downloader')
 logger = logging.getLogger('clipy.server')
 # views_logger = logging.getLogger('clipy:views')
 
+CACHE_FILE = 'metadata.json'
+CATALOG_FILE = 'catalog.json'
+JOBS_FILE = 'jobs.sqlite'
 
-def init(app):
+
+def init(app, config=None):
+    config = config or clipy.config.get_defaults()
+    app['config'] = config
     app['server'] = dict()
     app['actives'] = dict()
+    app['cache'] = clipy.cache.MetadataCache(path=os.path.join(config['data_dir'], CACHE_FILE))
+    app['catalog'] = clipy.catalog.Catalog(
+        config['download_dir'], os.path.join(config['data_dir'], CATALOG_FILE))
+    app['store'] = clipy.store.JobStore(
+        os.path.join(config['data_dir'], JOBS_FILE), app['actives'])
+    app['slow'] = clipy.monitor.SlowCallbackMonitor()
+    app['slow'].on_slow.append(clipy.metrics.SLOW_CALLBACKS.observe)
     clipy.routes.setup_routes(app)
     aiohttp_jinja2.setup(app, loader=jinja2.PackageLoader('clipy', 'templates'))
     app.router.add_static('/static/', path='static', name='static')
@@ -62,24 +80,64 @@ async def on_startup(app):
         host, port = socket.getsockname()
         return 'http://{}:{}/'.format(host, port)
 
-    app['server']['running'] = True
+    def refresh(stream):
+        return clipy.agents.utils.refresh_url(stream, app['session'], app['cache'])
+
+    config = app['config']
+    app['cache'].load()
+    app['catalog'].load()
+    app['catalog'].scan()
+    app['session'] = clipy.request.create_session(
+        config['connections'], config['connections_per_host'])
+    app['scheduler'] = clipy.scheduler.DownloadScheduler(
+        app['actives'],
+        app['session'],
+        concurrency=config['concurrency'],
+        limiter=clipy.throttle.BandwidthLimiter(config['rate']),
+        segments=config['segments'],
+        directory=config['download_dir'],
+        catalog=app['catalog'],
+        retry=clipy.download.RetryPolicy(
+            config['retries'], stall=config['stall'], refresh=refresh),
+    )
+    app['state'] = clipy.events.ProgressState(app['actives'], app['scheduler'])
+    app['hub'] = clipy.events.ProgressHub(app['actives'])
+    app['scheduler'].on_transition.append(app['hub'].transition)
+    app['hub'].start()
+    app['store'].open()
+    app['scheduler'].on_transition.append(app['store'].record)
+    app['store'].resume(app['scheduler'])
+    app['store'].start()
+    app['monitor'] = clipy.monitor.LagMonitor()
+    app['monitor'].on_sample.append(clipy.metrics.LOOP_LAG.observe)
+    app['monitor'].start()
+    if config['slow_callback']:
+        app['slow'].enable(config['slow_callback'])
+    app['server']['stop'] = asyncio.Event()
     uri = get_server_uri()
     logger.info(f'serving on {uri}')
 
 
 async def on_shutdown(app):
     logger.info(f'shutdown: {app}')
+    await app['hub'].close()
+    await app['monitor'].close()
 
 
 async def on_cleanup(app):
     logger.info(f'cleanup: {app}')
+    await app['store'].close()
+    await app['scheduler'].close()
     app['actives'].clear()
+    await app['session'].close()
+    app['cache'].save()
+    app['catalog'].save()
+    app['slow'].disable()
     app['server'].clear()
 
 
 async def run_loop(app):
-    while app['server']['running']:
-        await asyncio.sleep(2)
+    await app['server']['stop'].wait()
 
 
 async def error_middleware(app, next_handler):
@@ -89,6 +147,7 @@ async def error_middleware(app, next_handler):
             return response
         except Exception as e:
             logger.error(e)
+            clipy.metrics.ERRORS.labels(e.__class__.__name__).inc()
             data = dict(
                 title='Error',
                 message=str(e),
@@ -99,16 +158,39 @@ async def error_middleware(app, next_handler):
     return middleware_handler
 
 
-def main():
+async def metrics_middleware(app, next_handler):
+    async def middleware_handler(request):
+        start = time.monotonic()
+        try:
+            return await next_handler(request)
+        finally:
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else 'unmatched'
+            histogram = clipy.metrics.HTTP_SECONDS.labels(route, request.method)
+            histogram.observe(time.monotonic() - start)
+    return middleware_handler
+
+
+def main(argv=None):
+    config = clipy.config.load(argv)
+    clipy.config.configure_logging(config)
+    asyncio_logger = logging.getLogger('asyncio')
+    asyncio_logger.addFilter(PollFilter())
+    clipy.config.install_loop(config)
+
+    loop = asyncio.get_event_loop()
+    loop.set_debug(config['debug'])
     app = aiohttp.web.Application(
-        debug=True,
-        middlewares=[error_middleware],
+        debug=config['debug'],
+        middlewares=[metrics_middleware, error_middleware],
         # logger=logger,
     )
     # aiohttp.web.run_app(app, host='127.0.0.1', port=7070)
-    init(app)
-    handler = app.make_handler(loop=loop)
-    f = loop.create_server(handler, '127.0.0.1', 7070)
+    init(app, config)
+    logger.info(f'{config["profile"]} profile, downloading to {config["download_dir"]}')
+    access_log = logging.getLogger('aiohttp.access') if config['access_log'] else None
+    handler = app.make_handler(loop=loop, access_log=access_log)
+    f = loop.create_server(handler, config['host'], config['port'])
     srv = loop.run_until_complete(f)
     app['server']['sockets'] = srv.sockets
     try:
@@ -0,0 +1,170 @@
+"""
+Clipy persistent job store
+
+Jobs are recorded in an SQLite database in WAL mode as the scheduler moves them from state to
+state, with the stream they download, its resolved URL and the bytes done so far.  A restarted
+server submits the jobs that were queued or running again, and the downloader resumes their
+partial files.  The transitions and the progress of all the transferring streams are written
+together every ``INTERVAL`` in a thread of the store's own, so neither the chunk loop nor the
+event loop waits on a commit.  Jobs that have ended are deleted.
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import concurrent.futures
+
+import clipy.models
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = 2  # Seconds between writes
+PENDING = ('queued', 'running', 'stalled')  # States of the jobs taken up again at startup
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    sid TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    stream TEXT NOT NULL,
+    bytesdone INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)
+'''
+
+_executor = None
+
+
+def _get_executor():
+    # One thread so the writes are made in order, off the event loop
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(1, 'clipy-store')
+    return _executor
+
+
+class JobStore():
+    """Jobs of the scheduler kept in the SQLite database at ``path``
+
+    ``record`` is a scheduler transition callback; ``actives`` is the application's dictionary
+    of transferring streams whose progress is written every ``interval``, with the transitions
+    recorded since the last write.
+    """
+    def __init__(self, path, actives, interval=INTERVAL):
+        self.path = path
+        self.actives = actives
+        self.interval = interval
+        self.db = None
+        self.task = None
+        self.stamps = dict()
+        self.transitions = list()
+
+    def __repr__(self):
+        return f'<JobStore {self.path}>'
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(SCHEMA)
+        self.db.commit()
+        logger.info(f'opened {self}')
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self.task = loop.create_task(self._run())
+
+    async def close(self):
+        """Write the last progress and stop recording, jobs cancelled after are resumed later"""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.wait([self.task])
+            self.task = None
+        if self.db is not None:
+            await self.flush()
+            self.db.close()
+            self.db = None
+            logger.info(f'closed {self}')
+
+    def load(self):
+        """Return the streams of the jobs that were queued, running or stalled, oldest first
+
+        Rows of jobs that ended, if any are left, are deleted first.
+        """
+        self.db.execute('DELETE FROM jobs WHERE state NOT IN (?, ?, ?)', PENDING)
+        self.db.commit()
+        rows = self.db.execute(
+            'SELECT stream, bytesdone, total FROM jobs WHERE state IN (?, ?, ?) ORDER BY created',
+            PENDING)
+        streams = list()
+        for data, bytesdone, total in rows:
+            stream = clipy.models.StreamModel.restore(json.loads(data))
+            stream.progress.start(total, bytesdone)
+            streams.append(stream)
+        logger.info(f'{len(streams)} jobs to resume from {self}')
+        return streams
+
+    def resume(self, scheduler):
+        """Submit the jobs that were pending to the scheduler again"""
+        for stream in self.load():
+            job = scheduler.submit(stream)
+            if job.state == 'finished':
+                # already downloaded, the scheduler made no transition
+                self.record(job)
+
+    def record(self, job):
+        """Scheduler callback, queue the job's new state for the next write"""
+        if self.db is None:
+            return
+
+        progress = job.stream.progress
+        self.transitions.append((
+            job.sid, job.state, json.dumps(job.stream.fields()), progress.bytesdone,
+            progress.total, time.time()))
+
+    async def flush(self):
+        """Write the transitions and the progress of the streams that moved since the last write,
+        in one transaction
+        """
+        rows = list()
+        stamps = dict()
+        for sid, stream in self.actives.items():
+            progress = stream.progress
+            stamps[sid] = progress.stamp
+            if self.stamps.get(sid) != stamps[sid]:
+                rows.append((progress.bytesdone, progress.total, time.time(), sid))
+        self.stamps = stamps
+        transitions, self.transitions = self.transitions, list()
+        if transitions or rows:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(_get_executor(), self._write, transitions, rows)
+
+    def _write(self, transitions, rows):
+        for sid, state, stream, bytesdone, total, now in transitions:
+            if state == 'queued':
+                # a new job, or one submitted again, goes to the back of the queue
+                self.db.execute(
+                    'INSERT OR REPLACE INTO jobs (sid, state, stream, bytesdone, total, created, '
+                    'updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (sid, state, stream, bytesdone, total, now, now))
+            elif state in PENDING:
+                self.db.execute(
+                    'UPDATE jobs SET state = ?, stream = ?, updated = ? WHERE sid = ?',
+                    (state, stream, now, sid))
+            else:
+                self.db.execute('DELETE FROM jobs WHERE sid = ?', (sid,))
+        self.db.executemany(
+            'UPDATE jobs SET bytesdone = ?, total = ?, updated = ? WHERE sid = ?', rows)
+        self.db.commit()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logger.error(f'{self} {e}')
@@ -0,0 +1,91 @@
+"""
+Clipy download bandwidth limiting
+
+Token buckets cap the bytes per second read by all downloads together and by single streams.
+The downloader asks ``BandwidthLimiter.delay`` how long to pause after each chunk, so when no
+limit is set the cost is a couple of attribute lookups.
+"""
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+BURST = 1.0  # Seconds of transfer at the full rate allowed in one burst
+
+_clock = time.monotonic
+
+
+class TokenBucket():
+    """Allow ``rate`` bytes per second on average and up to ``burst`` bytes at once
+
+    Taking more tokens than are available puts the bucket in debt and the taker is told how
+    long to wait for it to be paid off, so takers of equal chunks get equal shares of the rate.
+    """
+    def __init__(self, rate=None, burst=None):
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0
+        self.stamp = _clock()
+        self.set_rate(rate, burst)
+
+    def __repr__(self):
+        return f'<TokenBucket {self.rate} B/s>'
+
+    def set_rate(self, rate, burst=None):
+        """Set the rate in bytes per second, None or 0 for no limit"""
+        unlimited = self.rate is None
+        self.rate = rate or None
+        self.burst = burst or (rate or 0) * BURST
+        if unlimited:
+            # A newly limited bucket starts full
+            self.tokens = self.burst
+            self.stamp = _clock()
+        self.tokens = min(self.tokens, self.burst)
+
+    def take(self, length):
+        """Take ``length`` tokens and return the seconds to wait before using them"""
+        if self.rate is None:
+            return 0.0
+
+        now = _clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= length
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthLimiter():
+    """A global bucket shared by all downloads and optional buckets for single streams
+    """
+    def __init__(self, rate=None):
+        self.bucket = TokenBucket(rate)
+        self.streams = dict()
+
+    def __repr__(self):
+        return f'<BandwidthLimiter {self.bucket.rate} B/s {len(self.streams)} streams>'
+
+    def limit(self, rate, sid=None):
+        """Set the rate in bytes per second for all downloads, or for the stream ``sid``"""
+        if sid is None:
+            self.bucket.set_rate(rate)
+        elif rate:
+            self.streams.setdefault(sid, TokenBucket()).set_rate(rate)
+        else:
+            self.streams.pop(sid, None)
+        logger.info(f'limit {sid or "all"} to {rate or "unlimited"} B/s, {self}')
+
+    def forget(self, sid):
+        self.streams.pop(sid, None)
+
+    def delay(self, sid, length):
+        """Seconds the stream ``sid`` should wait after reading ``length`` bytes"""
+        bucket = self.streams.get(sid)
+        if bucket is None:
+            return self.bucket.take(length)
+        return max(bucket.take(length), self.bucket.take(length))
+
+    def serial(self):
+        return dict(
+            rate=self.bucket.rate,
+            streams={sid: bucket.rate for sid, bucket in self.streams.items()},
+        )
@@ -1,15 +1,24 @@
+import json
+import time
+import asyncio
 import logging
 
 import aiohttp.web
 import aiohttp_jinja2
 
-import clipy.request
-import clipy.download
+import clipy.events
+import clipy.metrics
+import clipy.monitor
+import clipy.serial
 
 from clipy.agents.utils import lookup_agent, get_agent
+from clipy.agents.youtube import YoutubeAgent, select_stream
 
 logger = logging.getLogger(__name__)
 
+BATCH_CONCURRENCY = 8  # Videos of one batch inquiry looked up at once
+BATCH_SIZE = 500  # Most videos in one batch inquiry
+
 
 @aiohttp_jinja2.template('index.html')
 async def index(request):
@@ -21,66 +30,343 @@ async def index(request):
 
 async def inquire(request):
     video_url = request.query.get('video')
-    agent = lookup_agent(video_url)
+    agent = lookup_agent(video_url, request.app['session'], request.app['cache'])
     logger.debug(f'inquire - Agent: {agent}')
     video = await agent.get_video()
-    # data = dict(
-    #     description=video.description,
-    #     duration=video.duration,
-    #     streams=[s.serial for s in video.streams],
-    #     title=video.title,
-    #     vid=video.vid,
-    # )
-    return aiohttp.web.json_response(video.serial())
+    _mark_downloaded(request.app, video)
+    return clipy.serial.json_response(video.to_json())
+
+
+async def inquire_batch(request):
+    """Inquire about many videos and stream back one line of JSON for each as it is found
+
+    The body is a JSON list of video urls or ids, or one per line.  Up to
+    ``BATCH_CONCURRENCY`` are looked up at once; each line has the ``index`` and ``video`` asked
+    for and either the video's ``result`` or the ``error`` that prevented it.
+    """
+    videos = _parse_batch(await request.text())
+    if len(videos) > BATCH_SIZE:
+        raise ValueError(f'Batch of {len(videos)} videos, {BATCH_SIZE} at most')
+
+    app = request.app
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def lookup(index, video_url):
+        item = dict(index=index, video=video_url)
+        async with semaphore:
+            try:
+                agent = lookup_agent(video_url, app['session'], app['cache'])
+                video = await agent.get_video()
+                _mark_downloaded(app, video)
+                item.update(result=video.to_json())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'inquire_batch: {video_url} {e}')
+                item.update(error=str(e))
+        return item
+
+    response = aiohttp.web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    tasks = [asyncio.ensure_future(lookup(i, v)) for i, v in enumerate(videos)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            item = await task
+            await response.write(clipy.serial.encode(item) + b'\n')
+    except ConnectionResetError:
+        logger.debug('inquire_batch: client gone')
+    finally:
+        for task in tasks:
+            task.cancel()
+    return response
 
 
 async def download(request):
+    """Queue the stream for download, or attach to the job already downloading it
+
+    A stream whose file is already downloaded is not queued again.  With ``wait`` the response
+    is held until the job ends.
+    """
     vid = request.query.get('vid')
     idx = request.query.get('stream')
-    agent = get_agent(vid)
+    agent = get_agent(vid, request.app['session'], request.app['cache'])
     logger.debug(f'download - Agent: {agent}')
     stream = await agent.get_stream(idx)
 
-    # check if stream is already tasked to download
-    if stream.filename in clipy.download.get_pending_tasks():
+    scheduler = request.app['scheduler']
+    job = scheduler.submit(stream)
+    if job.stream is not stream:
         message = 'Already tasked'
+    elif job.state == 'finished':
+        message = 'Already downloaded'
     else:
-        # run download as task in the background
-        message='Queued'
-        coroutine = clipy.download.get(stream, request.app['actives'])
-        request.app.loop.create_task(coroutine)
+        message = 'Queued'
+    if 'wait' in request.query:
+        await job.wait()
 
     # return something to our client
     logger.info(f'{stream} {message}')
     data = dict(
         message=message,
         stream=str(stream),
+        sid=job.sid,
+        state=job.state,
+    )
+    return aiohttp.web.json_response(data)
+
+
+async def download_list(request):
+    """Queue a stream of every video in a YouTube playlist or channel
+
+    The stream is chosen by ``profile``, an itag or ``best`` (the default) or ``audio``.
+    Videos without such a stream, or whose info cannot be fetched, are listed as skipped, and
+    those already tasked or downloaded are not queued again.
+    """
+    lookup = request.query.get('list')
+    profile = request.query.get('profile', 'best')
+    agent = lookup_agent(lookup, request.app['session'], request.app['cache'])
+    if not isinstance(agent, YoutubeAgent) or not agent.is_list:
+        raise ValueError(f'Not a playlist or channel: {lookup}')
+
+    scheduler = request.app['scheduler']
+    queued = list()
+    tasked = list()
+    downloaded = list()
+    skipped = list()
+    for vid, video in await agent.get_videos():
+        if isinstance(video, Exception):
+            skipped.append(dict(vid=vid, error=str(video)))
+            continue
+        stream = select_stream(video, profile)
+        job = stream and scheduler.find(stream)
+        if stream is None:
+            skipped.append(dict(vid=vid, error=f'No {profile} stream'))
+        elif job is not None:
+            tasked.append(job.sid)
+        elif scheduler.is_downloaded(stream):
+            downloaded.append(stream.sid)
+        else:
+            stream = agent.load_stream(video, stream.index)
+            scheduler.submit(stream)
+            queued.append(stream.sid)
+
+    logger.info(f'download_list: {lookup} queued {len(queued)} skipped {len(skipped)}')
+    data = dict(
+        queued=queued,
+        tasked=tasked,
+        downloaded=downloaded,
+        skipped=skipped,
     )
     return aiohttp.web.json_response(data)
 
 
 async def progress(request):
+    """Report the downloads, or with ``since`` the version of an earlier report, what changed
+
+    A delta has the ``actives`` that changed and the sids ``removed`` since, and the pending
+    ``downloads`` only if they changed.  The ``ETag`` is the version, so a client that sends it
+    back gets ``304 Not Modified`` while nothing changes.
+    """
+    app = request.app
+    state = app['state']
+    version = state.update()
+    etag = f'"{version}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if request.headers.get('If-None-Match') == etag:
+        return aiohttp.web.Response(status=304, headers=headers)
+
+    since = request.query.get('since')
+    delta = state.delta(int(since)) if since and since.isdigit() else None
+    if delta is None:
+        data = dict(version=version, **_get_progress(app))
+        return clipy.serial.json_response(data, headers=headers)
+
+    changed, removed = delta
+    actives = app['actives']
+    data = dict(
+        version=version,
+        since=int(since),
+        actives=clipy.serial.array(actives[sid].to_json() for sid in changed),
+        removed=removed,
+        limits=state.limits,
+        rate=_get_rate(app),
+    )
+    if state.pending_version > int(since):
+        data.update(downloads=state.pending)
+    return clipy.serial.json_response(data, headers=headers)
+
+
+async def metrics(request):
+    """Report the telemetry in the Prometheus text format"""
+    app = request.app
+    scheduler = app['scheduler']
+    stalled = sum(job.state == 'stalled' for job in scheduler.running.values())
+    clipy.metrics.JOBS.labels('running').set(len(scheduler.running) - stalled)
+    clipy.metrics.JOBS.labels('stalled').set(stalled)
+    clipy.metrics.JOBS.labels('queued').set(len(scheduler.queue))
+    clipy.metrics.JOB_RATE.clear()
+    for sid, stream in app['actives'].items():
+        clipy.metrics.JOB_RATE.labels(sid).set(stream.progress.rate)
+    clipy.metrics.RATE.set(_get_rate(app))
+    body = clipy.metrics.render().encode()
+    return aiohttp.web.Response(body=body, headers={'Content-Type': clipy.metrics.CONTENT_TYPE})
+
+
+async def limits(request):
+    """Show the bandwidth limits, or set one with ``rate`` in bytes per second
+
+    The limit is for all downloads together unless a stream ``sid`` is given; a rate of 0
+    removes the limit.
+    """
+    limiter = request.app['scheduler'].limiter
+    if 'rate' in request.query:
+        rate = int(request.query['rate'] or 0)
+        limiter.limit(rate, request.query.get('sid'))
     data = dict(
-        actives=[s.serial() for s in request.app['actives'].values()],
-        downloads=clipy.download.get_pending_tasks(request.app.loop),
+        limits=limiter.serial(),
+        rate=_get_rate(request.app),
     )
     return aiohttp.web.json_response(data)
 
 
+async def events(request):
+    """Stream download events to the client as Server-Sent Events
+
+    A ``snapshot`` event with the same data as ``progress`` is sent first and is followed by
+    ``transition`` and ``progress`` events as they are published.
+    """
+    hub = request.app['hub']
+    subscriber = hub.subscribe()
+    response = aiohttp.web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+    })
+    await response.prepare(request)
+    try:
+        snapshot = _get_progress(request.app)
+        await response.write(clipy.events.format_event('snapshot', snapshot))
+        while True:
+            try:
+                item = await asyncio.wait_for(subscriber.get(), clipy.events.HEARTBEAT)
+            except asyncio.TimeoutError:
+                await response.write(b': keep-alive\n\n')
+                continue
+            if item is None:
+                break
+            await response.write(clipy.events.format_event(*item))
+    except ConnectionResetError:
+        logger.debug('events: client gone')
+    finally:
+        hub.unsubscribe(subscriber)
+    return response
+
+
 async def cancel(request):
     sid = request.query.get('sid')
-    actives = request.app['actives']
-    if sid in actives:
-        del actives[sid]
-        removed = True
-    else:
-        removed = False
+    removed = request.app['scheduler'].cancel(sid)
     logger.debug(f'cancel: sid {sid} removed? {removed}')
     data = dict(removed=removed)
     return aiohttp.web.json_response(data)
 
 
+async def move(request):
+    sid = request.query.get('sid')
+    front = request.query.get('to', 'front') == 'front'
+    moved = request.app['scheduler'].move(sid, front)
+    logger.debug(f'move: sid {sid} to front? {front} moved? {moved}')
+    data = dict(moved=moved)
+    return aiohttp.web.json_response(data)
+
+
+async def monitor(request):
+    """Show the event loop lag and slow callbacks, or report callbacks slower than ``slow``
+
+    ``slow`` is in seconds, 0 stops the reporting.
+    """
+    slow = request.app['slow']
+    if 'slow' in request.query:
+        threshold = float(request.query['slow'] or 0)
+        if threshold:
+            slow.enable(threshold)
+        else:
+            slow.disable()
+    lag = request.app['monitor']
+    data = dict(
+        lag=lag.lag,
+        peak=lag.peak,
+        slow=slow.serial(),
+    )
+    return aiohttp.web.json_response(data)
+
+
+async def profile(request):
+    """Profile the server for ``seconds`` and return the result as a file to download
+
+    ``mode`` is ``cprofile`` for a pstats file or ``sample`` for stack samples collapsed for
+    flame graph tools.
+    """
+    seconds = min(float(request.query.get('seconds', 5)), clipy.monitor.MAX_PROFILE)
+    mode = request.query.get('mode', 'cprofile')
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    if mode == 'cprofile':
+        body = await clipy.monitor.profile(seconds)
+        filename = f'clipy-{stamp}.prof'
+    elif mode == 'sample':
+        body = await clipy.monitor.sample(seconds)
+        filename = f'clipy-{stamp}.folded'
+    else:
+        raise ValueError(f'Unknown profile mode "{mode}"')
+
+    logger.info(f'profile: {mode} {seconds} s, {len(body)} bytes')
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    return aiohttp.web.Response(body=body, content_type='application/octet-stream',
+                                headers=headers)
+
+
 async def shutdown(request):
-    request.app['server']['running'] = False
+    request.app['server']['stop'].set()
     data = dict(app=str(request.app))
     return aiohttp.web.json_response(data)
+
+
+def _get_progress(app):
+    return dict(
+        actives=clipy.serial.array(s.to_json() for s in app['actives'].values()),
+        downloads=app['scheduler'].pending,
+        limits=app['scheduler'].limiter.serial(),
+        rate=_get_rate(app),
+    )
+
+
+def _mark_downloaded(app, video):
+    """Mark the video's streams whose files are in the catalog of completed downloads"""
+    catalog = app.get('catalog')
+    if catalog is not None:
+        for stream in video.streams:
+            stream.downloaded = catalog.find(stream) is not None
+
+
+def _get_rate(app):
+    """Measured throughput of all downloads together in bytes per second"""
+    return sum(s.progress.rate for s in app['actives'].values())
+
+
+def _parse_batch(text):
+    """Return the videos in a JSON list, or in lines of urls, ids or JSON strings
+
+    >>> _parse_batch('["abc", "def"]')
+    ['abc', 'def']
+    >>> _parse_batch('abc\\n"def"\\n\\n')
+    ['abc', 'def']
+    """
+    text = text.strip()
+    if text.startswith('['):
+        videos = json.loads(text)
+    else:
+        videos = [
+            json.loads(line) if line.startswith('"') else line
+            for line in (line.strip() for line in text.splitlines()) if line
+        ]
+    if not all(isinstance(v, str) for v in videos):
+        raise ValueError('Batch must be video urls or ids')
+    return videos
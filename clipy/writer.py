@@ -0,0 +1,184 @@
+"""
+Clipy disk writer
+
+File system calls block, so the downloader hands them to a small pool of writer threads and
+the event loop stays free to serve requests and other downloads.  Chunks read from the network
+are gathered into large aligned batches in reused buffers; each file has at most ``DEPTH``
+batches waiting and ``FileWriter.write`` waits for room, which slows the network reader down to
+the disk's pace.
+"""
+import os
+import errno
+import asyncio
+import logging
+import functools
+import collections
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 2  # Writer threads shared by all downloads
+BATCH = 2**20  # Bytes gathered before a write, a multiple of ALIGN
+ALIGN = 2**16  # Batches end on a multiple of this
+DEPTH = 4  # Batches waiting per file before ``write`` blocks
+NO_SPACE = (errno.ENOSPC, errno.EDQUOT)  # Errors of a preallocation that must fail the download
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(WORKERS, 'clipy-writer')
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    """Call a blocking file system function in a writer thread"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _pwrite(fd, buffer, length, position):
+    view = memoryview(buffer)[:length]
+    while view:
+        written = os.pwrite(fd, view, position)
+        view = view[written:]
+        position += written
+
+
+def _preallocate(fd, length):
+    # Only a lack of space is an error, a file system that cannot reserve it just grows the file
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, length)
+            return
+        except OSError as e:
+            if e.errno in NO_SPACE:
+                raise
+    os.ftruncate(fd, length)
+
+
+class FileWriter():
+    """Write a run of bytes into a file from ``position`` onwards in a writer thread
+
+    Bytes are copied into one of a few preallocated buffers that are reused for the life of the
+    writer; a full buffer is written with a single positional write.  The buffers of one file
+    are written one after the other in order, so the file never has a hole behind the last byte
+    written.
+    """
+    def __init__(self, path, batch=BATCH, depth=DEPTH):
+        self.path = path
+        self.batch = batch
+        self.fd = None
+        self.position = 0
+        self.buffer = bytearray(batch)
+        self.fill = 0
+        self.limit = batch
+        self.free = list()
+        self.pending = collections.deque()
+        self.slots = asyncio.Semaphore(depth)
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.busy = False
+        self.taken = 0
+        self.error = None
+
+    def __repr__(self):
+        return f'<FileWriter {self.path} @ {self.position + self.fill}>'
+
+    async def open(self, position=0, truncate=None, preallocate=None):
+        """Open the file for writing at ``position``
+
+        The file is first truncated to ``truncate`` bytes and then has ``preallocate`` bytes
+        reserved on disk, which fails right away if there is not enough space.
+        """
+        self.fd = await run(os.open, self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        if truncate is not None:
+            await run(os.ftruncate, self.fd, truncate)
+        if preallocate:
+            try:
+                await run(_preallocate, self.fd, preallocate)
+            except OSError:
+                await run(os.close, self.fd)
+                raise
+        self._seek(position)
+
+    async def write(self, data):
+        """Add bytes after those already written, waiting while the file's queue is full"""
+        self._check()
+        view = memoryview(data)
+        while view:
+            length = min(self.limit - self.fill, len(view))
+            self.buffer[self.fill:self.fill + length] = view[:length]
+            self.fill += length
+            view = view[length:]
+            if self.fill == self.limit:
+                await self._submit()
+
+    async def flush(self):
+        """Wait until every byte given to ``write`` is written"""
+        if self.fill:
+            await self._submit()
+        await self.idle.wait()
+        self._check()
+
+    async def close(self, fsync=False):
+        try:
+            await self.flush()
+            if fsync:
+                await run(os.fsync, self.fd)
+        finally:
+            await run(os.close, self.fd)
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _seek(self, position):
+        # Size the next buffer so its write ends on an aligned offset
+        self.position = position
+        self.limit = self.batch - position % ALIGN
+
+    async def _submit(self):
+        await self.slots.acquire()
+        if self.error is not None:
+            self.slots.release()
+            raise self.error
+        if not self.fill:
+            self.slots.release()
+            return
+
+        self.pending.append((self.buffer, self.fill, self.position))
+        self.buffer = self.free.pop() if self.free else bytearray(self.batch)
+        self._seek(self.position + self.fill)
+        self.fill = 0
+        self.taken += 1
+        self.idle.clear()
+        if not self.busy:
+            self._next()
+
+    def _next(self):
+        buffer, length, position = self.pending[0]
+        self.busy = True
+        future = asyncio.get_event_loop().run_in_executor(
+            _get_executor(), _pwrite, self.fd, buffer, length, position)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        buffer, length, position = self.pending.popleft()
+        self.free.append(buffer)
+        self.busy = False
+        self.taken -= 1
+        self.slots.release()
+        if future.exception() is not None:
+            self.error = future.exception()
+            logger.error(f'{self} {self.error}')
+            while self.pending:
+                self.free.append(self.pending.popleft()[0])
+                self.taken -= 1
+                self.slots.release()
+        if self.pending:
+            self._next()
+        if not self.taken:
+            self.idle.set()
@@ -4,17 +4,52 @@ cler
  */
 =(function(){"use strict";
 
+  // Version of the last progress report, to ask for what changed since
+  let
+    version = undefined,
+    _;
+
   /////////////////////////////////////////////////////////////////////////////
   // Public Functions
 
   /**
    * Periodically check the server for active download progress
+   *
+   * After the first report we ask only for what changed since the version we have, and the
+   * server answers 304 Not Modified while nothing has.
    */
   function check_progress() {
-    http.get('/api/progress')
+    let
+      url = version ? '/api/progress?since=' + version : '/api/progress',
+      headers = version ? { 'If-None-Match': '"' + version + '"' } : {},
+      _;
+
+    http.get( url, headers )
     .then( json.parse         )
+    .then( _take_version      )
     .then( clui.show_progress )
-    .fail( _bail              )
+    .fail( _unless_unmodified )
+  }
+
+  /**
+   * Subscribe to the server's download events, falling back to polling without EventSource
+   *
+   * Progress arrives coalesced for just the streams that moved; on a job state transition we
+   * refresh the whole picture once.
+   */
+  function watch_progress() {
+    if ( !window.EventSource ) {
+      setInterval(check_progress, 2000)
+      return
+    }
+    let
+      source = new EventSource('/api/events'),
+      _;
+
+    source.addEventListener('snapshot',   e => clui.show_progress( JSON.parse( e.data ) ))
+    source.addEventListener('progress',   e => clui.update_progress( JSON.parse( e.data ) ))
+    source.addEventListener('transition', e => check_progress())
+    source.onerror = e => { version = undefined; clui.show_progress( undefined ) }
   }
 
   /**
@@ -34,11 +69,21 @@ cler
     console.log(e)
   }
 
+  function _take_version( data ) {
+    version = data.version
+    return data
+  }
+
+  function _unless_unmodified( e ) {
+    if ( e !== 304 ) _bail( e )
+  }
+
   /////////////////////////////////////////////////////////////////////////////
   // Declare Public interface
 
   return {
     check_progress: check_progress,
+    watch_progress: watch_progress,
     shutdown: shutdown,
   }
 
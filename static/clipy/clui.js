@@ -37,6 +37,9 @@ clui
    * Called every few seconds with the servers list of streams actively downloading
    *
    * data: { actives: [ { bytesdone: 91750, elapsed: 7.58, total: 627020, sid: "1M6sk2zD6D8|17" },... ]}
+   *
+   * A delta from the version the client had has only the streams that changed and the sids
+   * of those removed, and the downloads only if they changed.
    */
   function show_progress( data ) {
     let
@@ -49,7 +52,14 @@ clui
 
       if ( data.actives ) {
         _add_active_progress_bars( data.actives )
-        _remove_dead_progress_bars( data.actives )
+        if ( data.removed ) {
+          _remove_progress_bars( data.removed )
+        }
+        else {
+          _remove_dead_progress_bars( data.actives )
+        }
+      }
+      if ( data.downloads ) {
         _show_downloads(data.downloads)
       }
     }
@@ -59,6 +69,18 @@ clui
     }
   }
 
+  /**
+   * Update the progress bars of just the streams that moved
+   *
+   * Called with the coalesced progress events pushed by the server
+   *
+   * data: { actives: [ { bytesdone: 91750, elapsed: 7.58, total: 627020, sid: "1M6sk2zD6D8|17" },... ]}
+   */
+  function update_progress( data ) {
+    document.getElementById('running').checked = true;
+    _add_active_progress_bars( data.actives )
+  }
+
   /**
    * Remove all panels
    */
@@ -115,8 +137,8 @@ clui
         item = document.createElement('li'),
         text = document.createTextNode( stream.display );
 
-      item.setAttribute('class', 'stream')
-      item.setAttribute('title', 'Download this stream')
+      item.setAttribute('class', stream.downloaded ? 'stream downloaded' : 'stream')
+      item.setAttribute('title', stream.downloaded ? 'Already downloaded' : 'Download this stream')
       item.setAttribute('index', i )
       item.setAttribute('vid', vid )
       item.appendChild( text )
@@ -356,6 +378,21 @@ clui
     }
   }
 
+  /**
+   * Remove the progress bars of the streams no longer active
+   *
+   * sids: [ "1M6sk2zD6D8|17",... ]
+   */
+  function _remove_progress_bars( sids ) {
+    for ( let sid of sids ) {
+      let progress = document.getElementById( sid );
+
+      if ( progress ) {
+        progress.parentElement.remove()
+      }
+    }
+  }
+
   /**
    * Show actual downloading tasks
    *
@@ -381,6 +418,7 @@ clui
 
   return {
     show_progress: show_progress,
+    update_progress: update_progress,
     inquire: inquire,
     clear: clear,
   }
@@ -7,11 +7,11 @@ http
   /*
    * HTTP GET
    *
-   * Promise-based async text loader using Q
+   * Promise-based async text loader using Q, rejected with the status when it is not 2xx
    *
    * https://github.com/bellbind/using-promise-q#setup-q-module
    */
-  function get( url ) {
+  function get( url, headers ) {
     let
       deferred = Q.defer(),
       request = new XMLHttpRequest();
@@ -23,6 +23,9 @@ http
       deferred.resolve(request.responseText)
     }
     request.open("GET", url, true)
+    for ( let name in headers || {} ) {
+      request.setRequestHeader( name, headers[name] )
+    }
     try {
       request.send()
     }
@@ -1,53 +1,37 @@
 """
 Clipy YouTube video downloader test suite
 """
-import curses
+import os
+import json
+import time
+import zlib
+import errno
+import marshal
 import asyncio
+import sqlite3
+import tempfile
 import unittest
 
-import pyperclip
+import aiohttp.web
+import aiohttp.test_utils
 
-import clipy.panel
-import clipy.window
-
-
-class ClipyUITest(unittest.TestCase):
-
-    def setUp(self):
-        def main(stdscr):
-            self.stdscr = stdscr
-            win1 = clipy.window.DetailWindow(6, 10, 0, 0)
-            win2 = clipy.window.ListWindow(6, 10, 10, 0)
-            win3 = clipy.window.Window(6, 50, 20, 0)
-            win4 = clipy.window.PopupWindow(3, 10, 10, 10)
-            panl = clipy.panel.Panel(None, self.stdscr, win1, win2, win3, win4)
-            panl.testing = True
-            self.panel = panl
-        curses.wrapper(main)
-
-    def test_1_windows_created(self):
-        """ Test that we can create the window abstration object correctly """
-        win = clipy.window.Window(10, curses.COLS, 12, 0)
-        self.assertIsInstance(win.box, type(curses.newwin(0, 0)))
-        self.assertIsInstance(win.win, type(curses.newwin(0, 0)))
-
-    def test_2_clipboard_communication(self):
-        """ Test that we can read info from the clipboard """
-        vid = 'mxvLMEyCXR0'
-        pyperclip.copy(vid)
-        self.assertEqual(vid, pyperclip.paste())
-
-    def test_3_reset(self):
-        """ Test that we can reset """
-        self.assertIsNone(self.panel.detail.video)
-        self.assertIsNotNone(self.panel.cache.videos)
-        self.panel.detail.video = object()
-        self.panel.cache.videos = None
-        self.assertIsNotNone(self.panel.detail.video)
-        self.assertIsNone(self.panel.cache.videos)
-        self.panel.reset()
-        self.assertIsNone(self.panel.detail.video)
-        self.assertIsNotNone(self.panel.cache.videos)
+import clipy.agents.youtube
+import clipy.cache
+import clipy.catalog
+import clipy.config
+import clipy.download
+import clipy.events
+import clipy.manifest
+import clipy.metrics
+import clipy.monitor
+import clipy.models
+import clipy.progress
+import clipy.request
+import clipy.scheduler
+import clipy.store
+import clipy.throttle
+import clipy.views
+import clipy.writer
 
 
 class ClipyAsyncTest(unittest.TestCase):
@@ -63,16 +47,14 @@ class ClipyAsyncTest(unittest.TestCase):
             pass
 
         loop = asyncio.get_event_loop()
-        loop.call_soon(normal_function())
+        loop.call_soon(normal_function)
 
     def test_3_coroutines(self):
-        @asyncio.coroutine
-        def coroutine_function_1():
-            result = yield from coroutine_function_2()
+        async def coroutine_function_1():
+            result = await coroutine_function_2()
             self.assertIs(result, True)
 
-        @asyncio.coroutine
-        def coroutine_function_2():
+        async def coroutine_function_2():
             return True
 
         loop = asyncio.get_event_loop()
@@ -82,6 +64,1103 @@ class ClipyAsyncTest(unittest.TestCase):
         # loop.create_task(print_and_repeat(future))
 
 
+class ClipyOriginTestCase(unittest.TestCase):
+    """ Serve a video file from a local origin to download from
+
+    Each of ``faults`` in turn spoils a response: ``'403'`` or ``'503'`` fails it, ``'reset'``
+    drops the connection half way and ``'stall'`` stops sending half way for ``stall`` seconds.
+    Every response waits ``delay`` seconds first.  The query and range of every request are kept
+    in ``requests``.
+    """
+
+    data = os.urandom(2**20 + 1234)
+    etag = '"v1"'
+    delay = 0
+    stall = 0.5
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+        self.loop = asyncio.new_event_loop()
+        self.faults = []
+        self.requests = []
+
+    def tearDown(self):
+        self.loop.close()
+        os.chdir(self.cwd)
+
+    def download(self, coroutine_function):
+        async def handler(request):
+            self.requests.append((request.query_string, request.headers.get('Range')))
+            await asyncio.sleep(self.delay)
+            headers = {'Accept-Ranges': 'bytes', 'ETag': self.etag}
+            rng = request.http_range
+            if rng.start is None or request.headers.get('If-Range', self.etag) != self.etag:
+                status, body = 200, self.data
+            else:
+                stop = min(rng.stop or len(self.data), len(self.data))
+                headers['Content-Range'] = f'bytes {rng.start}-{stop - 1}/{len(self.data)}'
+                status, body = 206, self.data[rng]
+
+            fault = self.faults.pop(0) if self.faults else None
+            if fault in ('403', '503'):
+                return aiohttp.web.Response(status=int(fault))
+            if fault is None:
+                return aiohttp.web.Response(status=status, body=body, headers=headers)
+
+            headers['Content-Length'] = str(len(body))
+            response = aiohttp.web.StreamResponse(status=status, headers=headers)
+            await response.prepare(request)
+            await response.write(body[:len(body) // 2])
+            if fault == 'stall':
+                await asyncio.sleep(self.stall)
+            request.transport.abort()
+            return response
+
+        async def run():
+            app = aiohttp.web.Application()
+            app.router.add_get('/video', handler)
+            server = aiohttp.test_utils.TestServer(app)
+            await server.start_server()
+            session = clipy.request.create_session()
+            video = clipy.models.VideoModel('abcdefghijk', dict(title='Test'))
+
+            def make_stream(index=0):
+                info = dict(url=str(server.make_url('/video')), filename=f'test{index}.mp4')
+                return clipy.models.StreamModel(info, video, index)
+
+            try:
+                return await coroutine_function(make_stream, session)
+            finally:
+                await session.close()
+                await server.close()
+
+        return self.loop.run_until_complete(run())
+
+
+class ClipyConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def test_1_precedence(self):
+        """ Test that the command line beats the environment, which beats the file and profile """
+        with open('clipy.json', 'w') as fd:
+            json.dump(dict(profile='development', port=8000, download_dir='media'), fd)
+        environ = dict(CLIPY_PORT='9000', CLIPY_LOG_LEVELS='clipy.download=WARNING')
+        argv = ['--config', 'clipy.json', '--concurrency', '5', '--no-debug']
+
+        config = clipy.config.load(argv, environ)
+
+        self.assertEqual(config['profile'], 'development')
+        self.assertEqual(config['log_level'], 'DEBUG')
+        self.assertIs(config['debug'], False)
+        self.assertEqual(config['port'], 9000)
+        self.assertEqual(config['concurrency'], 5)
+        self.assertEqual(config['download_dir'], 'media')
+        self.assertEqual(config['log_levels'], {'clipy.download': 'WARNING'})
+        self.assertEqual(clipy.config.load([], {})['debug'], False)
+
+    def test_2_unknown_setting(self):
+        """ Test that a misspelt setting in the file is refused """
+        with open('clipy.json', 'w') as fd:
+            json.dump(dict(concurency=5), fd)
+        with self.assertRaises(ValueError):
+            clipy.config.load(['--config', 'clipy.json'], {})
+
+
+class ClipyDownloadTest(ClipyOriginTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.block = clipy.manifest.BLOCK
+        clipy.manifest.BLOCK = 4096
+
+    def tearDown(self):
+        clipy.manifest.BLOCK = self.block
+        super().tearDown()
+
+    def seed(self, etag, corrupt=None):
+        """ Leave a partial download of four segments behind, optionally with a bad byte """
+        total = len(self.data)
+        segments = clipy.manifest.split(total, 4)
+        os.makedirs('videos')
+        with open('videos/test0.mp4.clipy', 'wb') as fd:
+            fd.truncate(total)
+            for i, segment in enumerate(segments):
+                segment.update(self.data[segment.start:segment.start + i * 10000])
+                fd.seek(segment.start)
+                fd.write(self.data[segment.start:segment.position])
+            if corrupt is not None:
+                fd.seek(corrupt)
+                fd.write(bytes([self.data[corrupt] ^ 0xff]))
+        sid = 'abcdefghijk|0'
+        manifest = clipy.manifest.Manifest(
+            'videos/test0.mp4.clipy.manifest', sid, total, etag, None, segments)
+        manifest.save()
+        return manifest
+
+    def resume(self):
+        async def resume(make_stream, session):
+            return await clipy.download.get(make_stream(), dict(), session, 4)
+
+        complete, bytesdone = self.download(resume)
+
+        self.assertTrue(complete)
+        self.assertEqual(bytesdone, len(self.data))
+        with open('videos/test0.mp4', 'rb') as fd:
+            self.assertEqual(fd.read(), self.data)
+        self.assertFalse(os.path.exists('videos/test0.mp4.clipy.manifest'))
+
+    def test_1_split(self):
+        """ Test that segments cover the whole stream without overlap """
+        segments = clipy.manifest.split(10, 3)
+        self.assertEqual([(s.start, s.end) for s in segments], [(0, 3), (4, 7), (8, 9)])
+
+    def test_2_segmented_resume(self):
+        """ Test that an interrupted download resumes every segment, refetching bad blocks """
+        start = clipy.manifest.split(len(self.data), 4)[3].start
+        manifest = self.seed(self.etag, corrupt=start + 25000)
+        manifest = clipy.manifest.Manifest.load(manifest.path)
+        manifest.verify('videos/test0.mp4.clipy')
+        self.assertEqual([s.done for s in manifest.segments], [0, 8192, 16384, 24576])
+        self.resume()
+
+    def test_3_source_changed(self):
+        """ Test that a partial download of different content is started over """
+        self.seed('"v0"')
+        self.resume()
+
+    def test_4_reconnect(self):
+        """ Test that failed and reset responses are retried, resuming from the last byte """
+        self.faults = ['503', 'reset', 'reset']
+        retry = clipy.download.RetryPolicy(backoff=0.01)
+
+        async def download(make_stream, session):
+            stream = make_stream()
+            return stream, await clipy.download.get(stream, dict(), session, 2, retry=retry)
+
+        stream, (complete, bytesdone) = self.download(download)
+        self.assertTrue(complete)
+        self.assertEqual(stream.progress.retries, 3)
+        self.assertEqual(stream.progress.serial()['retries'], 3)
+        with open('videos/test0.mp4', 'rb') as fd:
+            self.assertEqual(fd.read(), self.data)
+
+    def test_5_retry_budget(self):
+        """ Test that a download fails once it has used its retries """
+        self.faults = ['503'] * 3
+        retry = clipy.download.RetryPolicy(retries=2, backoff=0.01)
+
+        async def download(make_stream, session):
+            return await clipy.download.get(make_stream(), dict(), session, 2, retry=retry)
+
+        with self.assertRaises(aiohttp.ClientResponseError):
+            self.download(download)
+
+    def test_6_refresh_url(self):
+        """ Test that an expired URL is resolved again and the download goes on from its offset """
+        self.faults = ['reset', '403']
+
+        async def refresh(stream):
+            await asyncio.sleep(0.01)
+            return stream.url.partition('?')[0] + '?signature=2'
+
+        async def download(make_stream, session):
+            stream = make_stream()
+            retry = clipy.download.RetryPolicy(backoff=0.01, refresh=refresh)
+            return stream, await clipy.download.get(stream, dict(), session, 2, retry=retry)
+
+        stream, (complete, bytesdone) = self.download(download)
+        self.assertTrue(complete)
+        self.assertTrue(stream.url.endswith('?signature=2'))
+        self.assertEqual(stream.progress.retries, 2)
+        self.assertEqual(self.requests[1][0], '')
+        self.assertEqual(self.requests[2], ('signature=2', self.requests[1][1]))
+        self.assertNotEqual(self.requests[2][1], f'bytes=0-{len(self.data) - 1}')
+        with open('videos/test0.mp4', 'rb') as fd:
+            self.assertEqual(fd.read(), self.data)
+
+    def test_7_expired_without_refresh(self):
+        """ Test that an expired URL fails the download when it cannot be resolved again """
+        self.faults = ['403']
+
+        async def download(make_stream, session):
+            return await clipy.download.get(make_stream(), dict(), session, 2)
+
+        with self.assertRaises(aiohttp.ClientResponseError):
+            self.download(download)
+
+
+class ClipyBatchTest(unittest.TestCase):
+
+    def test_1_inquire_batch(self):
+        """ Test that a batch inquiry streams a line per video, with errors in place """
+        info = dict(
+            status='ok',
+            title='Test',
+            url_encoded_fmt_stream_map='itag=18&type=video%2Fmp4&quality=medium&url=http%3A%2F%2Fx',
+        )
+
+        async def inquire():
+            app = aiohttp.web.Application()
+            app.router.add_post('/api/inquire', clipy.views.inquire_batch)
+            app['session'] = clipy.request.create_session()
+            app['cache'] = clipy.cache.MetadataCache()
+            app['cache'].put('YoutubeAgent:abcdefghijk', info)
+            client = aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app))
+            await client.start_server()
+            try:
+                body = 'abcdefghijk\nno-such-video\n"https://www.youtube.com/watch?v=abcdefghijk"\n'
+                response = await client.post('/api/inquire', data=body)
+                return [json.loads(line) for line in (await response.text()).splitlines()]
+            finally:
+                await client.close()
+                await app['session'].close()
+
+        loop = asyncio.new_event_loop()
+        items = sorted(loop.run_until_complete(inquire()), key=lambda item: item['index'])
+        loop.close()
+
+        self.assertEqual([item['index'] for item in items], [0, 1, 2])
+        self.assertEqual(items[0]['result']['title'], 'Test')
+        self.assertIn('No suitable video agent', items[1]['error'])
+        self.assertEqual(items[2]['result']['vid'], 'abcdefghijk')
+
+
+class ClipyFixtureTestCase(unittest.TestCase):
+    """ Serve recorded YouTube responses from ``fixtures/youtube`` """
+
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'youtube')
+
+    def fetch(self, coroutine_function):
+        async def list_ajax(request):
+            name = f'list_ajax-{request.query["list"]}-{request.query["index"]}.json'
+            return aiohttp.web.FileResponse(os.path.join(self.fixtures, name))
+
+        async def get_video_info(request):
+            name = f'get_video_info-{request.query["video_id"]}.txt'
+            return aiohttp.web.FileResponse(os.path.join(self.fixtures, name))
+
+        async def run():
+            app = aiohttp.web.Application()
+            app.router.add_get('/list_ajax', list_ajax)
+            app.router.add_get('/get_video_info', get_video_info)
+            server = aiohttp.test_utils.TestServer(app)
+            await server.start_server()
+            session = clipy.request.create_session()
+
+            def make_agent(lookup):
+                agent = clipy.agents.youtube.YoutubeAgent(lookup, session, None)
+                agent.base_url = str(server.make_url('')).rstrip('/')
+                return agent
+
+            try:
+                return await coroutine_function(make_agent)
+            finally:
+                await session.close()
+                await server.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+
+class ClipyPlaylistTest(ClipyFixtureTestCase):
+
+    def test_1_paginated_expansion(self):
+        """ Test that pages are fetched by playlist position and repeated entries are dropped """
+        async def expand(make_agent):
+            agent = make_agent('https://www.youtube.com/playlist?list=PLfixture')
+            return await agent.get_video_ids()
+
+        vids = self.fetch(expand)
+        self.assertEqual(vids, ['aaaaaaaaaaa', 'bbbbbbbbbbb', 'ccccccccccc', 'ddddddddddd'])
+
+    def test_2_stream_profiles(self):
+        """ Test that entries are prefetched and a stream is chosen from each by profile """
+        async def prefetch(make_agent):
+            agent = make_agent('https://www.youtube.com/playlist?list=PLfixture')
+            return dict(await agent.get_videos())
+
+        videos = self.fetch(prefetch)
+        self.assertIsInstance(videos.pop('ddddddddddd'), ValueError)
+
+        def itag(vid, profile):
+            stream = clipy.agents.youtube.select_stream(videos[vid], profile)
+            return stream and stream.itag
+
+        self.assertEqual(itag('aaaaaaaaaaa', 'best'), '22')
+        self.assertEqual(itag('aaaaaaaaaaa', 'audio'), '140')
+        self.assertEqual(itag('bbbbbbbbbbb', 'best'), None)
+        self.assertEqual(itag('ccccccccccc', '18'), '18')
+
+    def test_3_queue_playlist(self):
+        """ Test that one request queues the chosen stream of every entry """
+        async def queue(make_agent):
+            base_url = clipy.agents.youtube.BASE_URL
+            clipy.agents.youtube.BASE_URL = make_agent('').base_url
+            app = aiohttp.web.Application()
+            app.router.add_get('/api/download/list', clipy.views.download_list)
+            app['session'] = clipy.request.create_session()
+            app['cache'] = clipy.cache.MetadataCache()
+            app['scheduler'] = clipy.scheduler.DownloadScheduler(dict(), None, concurrency=0)
+            client = aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app))
+            await client.start_server()
+            try:
+                query = dict(list='https://www.youtube.com/playlist?list=PLfixture', profile='18')
+                response = await client.get('/api/download/list', params=query)
+                return await response.json(), app['scheduler'].queue
+            finally:
+                clipy.agents.youtube.BASE_URL = base_url
+                await client.close()
+                await app['session'].close()
+
+        data, queue = self.fetch(queue)
+        self.assertEqual(data['queued'], ['aaaaaaaaaaa|1', 'ccccccccccc|0'])
+        self.assertEqual([s['vid'] for s in data['skipped']], ['bbbbbbbbbbb', 'ddddddddddd'])
+        self.assertEqual([job.sid for job in queue], data['queued'])
+        self.assertTrue(all(job.stream.url for job in queue))
+
+    def test_4_channel_by_name(self):
+        """ Test that channels known by name are refused rather than taken for a video """
+        for url in ('https://www.youtube.com/user/name', 'https://www.youtube.com/c/name/videos'):
+            agent = clipy.agents.youtube.YoutubeAgent(url, None)
+            with self.assertRaises(ValueError):
+                agent.is_list
+
+
+class ClipyModelTest(ClipyFixtureTestCase):
+
+    def test_1_compact_models(self):
+        """ Test that unused info is dropped and the models keep only their fields """
+        async def inquire(make_agent):
+            return [await make_agent(vid).get_video() for vid in ('aaaaaaaaaaa', 'ccccccccccc')]
+
+        first, second = self.fetch(inquire)
+        self.assertNotIn('player_response', first.info)
+        self.assertNotIn('keywords', first.info)
+        self.assertEqual((first.title, first.author, first.duration), ('First', 'clipy', '10'))
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertFalse(hasattr(first.streams[0], '__dict__'))
+        self.assertIs(first.streams[1].type, second.streams[0].type)
+        self.assertEqual(first.streams[0].serial()['itag'], '22')
+
+
+class ClipyStreamIndexTest(ClipyFixtureTestCase):
+
+    def test_1_lazy_streams(self):
+        """ Test that inquired streams are summaries and only a chosen stream is decoded """
+        async def inquire(make_agent):
+            agent = make_agent('aaaaaaaaaaa')
+            video = await agent.get_video()
+            return video, agent.load_stream(video, 2)
+
+        video, stream = self.fetch(inquire)
+        self.assertEqual(video.stream_index.itags, {'22': 0, '18': 1, '140': 2})
+        self.assertEqual([s.url for s in video.streams], [None, None, None])
+        self.assertEqual(list(video.stream_index._parsed), [2])
+        self.assertEqual(stream.url, 'http://127.0.0.1/videoplayback?id=aaaaaaaaaaa&itag=140')
+        self.assertEqual((stream.itag, stream.type), ('140', 'audio/mp4'))
+
+    def test_2_cached_index(self):
+        """ Test that the stream index is built once for the cached info of a video """
+        async def inquire(make_agent):
+            cache = clipy.cache.MetadataCache()
+            videos = list()
+            for i in range(2):
+                agent = make_agent('aaaaaaaaaaa')
+                agent.cache = cache
+                videos.append(await agent.get_video())
+            cache.invalidate('YoutubeAgent:aaaaaaaaaaa')
+            agent = make_agent('aaaaaaaaaaa')
+            agent.cache = cache
+            videos.append(await agent.get_video())
+            return videos
+
+        first, second, third = self.fetch(inquire)
+        self.assertIsNot(first, second)
+        self.assertIs(first.stream_index, second.stream_index)
+        self.assertIsNot(third.stream_index, first.stream_index)
+
+
+class ClipyRefreshTest(ClipyFixtureTestCase):
+
+    def test_1_refresh_url(self):
+        """ Test that a stream's URL is resolved again from fresh info, found by its itag """
+        async def refresh(make_agent):
+            agent = make_agent('aaaaaaaaaaa')
+            agent.cache = clipy.cache.MetadataCache()
+            agent.cache.put('YoutubeAgent:aaaaaaaaaaa', dict(
+                status='ok', title='First', url_encoded_fmt_stream_map=(
+                    'itag=140&type=audio%2Fmp4&url=http%3A%2F%2F127.0.0.1%2Fexpired')))
+            stream = await agent.get_stream(0)
+            return stream, await agent.refresh_url(stream)
+
+        stream, url = self.fetch(refresh)
+        self.assertEqual(stream.url, 'http://127.0.0.1/expired')
+        self.assertEqual(url, 'http://127.0.0.1/videoplayback?id=aaaaaaaaaaa&itag=140')
+
+
+class ClipySchedulerTest(ClipyOriginTestCase):
+
+    def test_1_queue(self):
+        """ Test that jobs beyond the concurrency limit queue and can be moved and cancelled """
+        async def schedule(make_stream, session):
+            scheduler = clipy.scheduler.DownloadScheduler(dict(), session, concurrency=1)
+            first, second, third = [scheduler.submit(make_stream(i)) for i in range(3)]
+            self.assertTrue(scheduler.is_running(first.sid))
+            self.assertTrue(scheduler.is_queued(second.sid))
+            self.assertIs(scheduler.submit(make_stream(1)), second)
+
+            self.assertTrue(scheduler.move(third.sid, front=True))
+            self.assertEqual(list(scheduler.queue), [third, second])
+            self.assertTrue(scheduler.cancel(second.sid))
+            self.assertFalse(scheduler.is_tasked(second.filename))
+
+            await first.task
+            self.assertTrue(scheduler.is_running(third.sid))
+            await third.task
+            return first, second, third
+
+        jobs = self.download(schedule)
+        self.assertEqual([job.state for job in jobs], ['finished', 'cancelled', 'finished'])
+        self.assertEqual(sorted(os.listdir('videos')), ['test0.mp4', 'test2.mp4'])
+
+    def test_2_cancel_connecting(self):
+        """ Test that a running job is cancelled while it waits for its first response """
+        self.delay = 1
+
+        async def schedule(make_stream, session):
+            scheduler = clipy.scheduler.DownloadScheduler(dict(), session)
+            job = scheduler.submit(make_stream())
+            await asyncio.sleep(0.2)
+            self.assertTrue(scheduler.is_running(job.sid))
+            self.assertTrue(scheduler.cancel(job.sid))
+            await asyncio.wait([job.task])
+            return job.state
+
+        self.assertEqual(self.download(schedule), 'cancelled')
+        self.assertFalse(os.path.exists('videos/test0.mp4'))
+
+    def test_3_coalesce(self):
+        """ Test that requests for a tasked stream share its job and a downloaded one is done """
+        async def schedule(make_stream, session):
+            scheduler = clipy.scheduler.DownloadScheduler(dict(), session, concurrency=1)
+            first = make_stream(0)
+            first.itag = '18'
+            again = make_stream(1)
+            again.itag = '18'
+            job = scheduler.submit(first)
+            self.assertIs(scheduler.submit(again), job)
+            states = await asyncio.gather(job.wait(), scheduler.submit(again).wait())
+
+            repeat = scheduler.submit(make_stream(0))
+            self.assertEqual((repeat.state, repeat.task), ('finished', None))
+            return states, await repeat.wait()
+
+        states, repeat = self.download(schedule)
+        self.assertEqual(states, ['finished', 'finished'])
+        self.assertEqual(repeat, 'finished')
+        self.assertEqual(os.listdir('videos'), ['test0.mp4'])
+
+    def test_4_stalled(self):
+        """ Test that a job without data is stalled until its connection is dropped and retried """
+        self.faults = ['stall']
+        self.stall = 1
+
+        async def schedule(make_stream, session):
+            retry = clipy.download.RetryPolicy(backoff=0.01, stall=0.1)
+            scheduler = clipy.scheduler.DownloadScheduler(dict(), session, retry=retry)
+            states = []
+            scheduler.on_transition.append(lambda job: states.append(job.state))
+            job = scheduler.submit(make_stream())
+            await job.wait()
+            return states, job.stream.progress.retries
+
+        states, retries = self.download(schedule)
+        self.assertEqual(states[:3], ['queued', 'running', 'stalled'])
+        self.assertEqual(states[-1], 'finished')
+        self.assertEqual(retries, 1)
+
+
+class ClipyCatalogTest(ClipyOriginTestCase):
+
+    def test_1_completed_downloads(self):
+        """ Test that finished downloads are recorded by key and found without a rescan """
+        os.makedirs('videos')
+        for name in ('old.mp4', 'part.mp4.clipy'):
+            with open(os.path.join('videos', name), 'wb') as fd:
+                fd.write(b'data')
+
+        async def schedule(make_stream, session):
+            catalog = clipy.catalog.Catalog('videos', 'catalog.json')
+            catalog.scan()
+            scheduler = clipy.scheduler.DownloadScheduler(dict(), session, catalog=catalog)
+            first = make_stream(0)
+            first.itag = '18'
+            self.assertEqual(await scheduler.submit(first).wait(), 'finished')
+            self.assertTrue(scheduler.is_downloaded(first))
+            await scheduler.close()  # waits for the catalog
+            catalog.save()
+
+            # the same format under another name is held, and removed files are noticed
+            again = make_stream(1)
+            again.itag = '18'
+            self.assertEqual(scheduler.submit(again).state, 'finished')
+            os.remove(os.path.join('videos', 'old.mp4'))
+            old = make_stream(2)
+            old.filename = 'old.mp4'
+            self.assertIsNone(catalog.find(old))
+            return catalog
+
+        catalog = self.download(schedule)
+        self.assertEqual(sorted(catalog.entries), ['test0.mp4'])
+        entry = catalog.entries['test0.mp4']
+        self.assertEqual(entry['key'], 'abcdefghijk|18')
+        self.assertEqual(entry['size'], len(self.data))
+        self.assertEqual(entry['checksum'], zlib.crc32(self.data))
+
+        loaded = clipy.catalog.Catalog('videos', 'catalog.json')
+        loaded.load()
+        self.assertEqual(loaded.keys, {'abcdefghijk|18': 'test0.mp4'})
+        self.assertIn('old.mp4', loaded.entries)
+        loaded.scan()
+        self.assertEqual(sorted(loaded.entries), ['test0.mp4'])
+
+
+class ClipyStoreTest(ClipyOriginTestCase):
+
+    def test_1_resume_jobs(self):
+        """ Test that queued and running jobs are recorded with their progress and resumed """
+        async def schedule(make_stream, session):
+            actives = dict()
+            store = clipy.store.JobStore(os.path.join('data', 'jobs.sqlite'), actives)
+            store.open()
+            scheduler = clipy.scheduler.DownloadScheduler(actives, session, concurrency=1)
+            scheduler.on_transition.append(store.record)
+            finished = scheduler.submit(make_stream(0))
+            running, queued = [scheduler.submit(make_stream(i)) for i in (1, 2)]
+            await finished.wait()
+
+            # the second is cut short as by a restart
+            actives[running.sid] = running.stream
+            running.stream.progress.start(len(self.data), 1000)
+            await store.close()
+            await scheduler.close()
+
+            store = clipy.store.JobStore(os.path.join('data', 'jobs.sqlite'), dict())
+            store.open()
+            streams = store.load()
+            scheduler = clipy.scheduler.DownloadScheduler(dict(), session, concurrency=1)
+            scheduler.on_transition.append(store.record)
+            store.resume(scheduler)
+            jobs = list(scheduler.jobs.values())
+            await asyncio.gather(*(job.wait() for job in jobs))
+            await store.close()
+            return streams, jobs
+
+        streams, jobs = self.download(schedule)
+        self.assertEqual([s.sid for s in streams], ['abcdefghijk|1', 'abcdefghijk|2'])
+        self.assertEqual([s.progress.bytesdone for s in streams], [1000, 0])
+        self.assertEqual(streams[0].url, jobs[0].stream.url)
+        self.assertEqual([job.state for job in jobs], ['finished', 'finished'])
+        self.assertEqual(sorted(os.listdir('videos')), ['test0.mp4', 'test1.mp4', 'test2.mp4'])
+        db = sqlite3.connect(os.path.join('data', 'jobs.sqlite'))
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM jobs').fetchone(), (0,))
+        db.close()
+
+
+class ClipyEventsTest(unittest.TestCase):
+
+    def test_1_coalesced_progress(self):
+        """ Test that progress is pushed once per interval and only for streams that moved """
+        video = clipy.models.VideoModel('abcdefghijk', dict(title='Test'))
+        moving, idle = [clipy.models.StreamModel(dict(), video, i) for i in range(2)]
+        actives = {moving.sid: moving, idle.sid: idle}
+
+        async def watch():
+            hub = clipy.events.ProgressHub(actives, interval=0.01)
+            hub.start()
+            subscriber = hub.subscribe()
+            events = [await subscriber.get()]
+            moving.progress.advance(100)
+            events.append(await subscriber.get())
+            await hub.close()
+            events.append(await subscriber.get())
+            return events
+
+        loop = asyncio.new_event_loop()
+        first, second, closed = loop.run_until_complete(watch())
+        loop.close()
+        self.assertEqual([s['sid'] for s in first[1]['actives']], [moving.sid, idle.sid])
+        self.assertEqual([s['sid'] for s in second[1]['actives']], [moving.sid])
+        self.assertIsNone(closed)
+
+    def test_2_event_stream(self):
+        """ Test that the event stream sends a snapshot, transitions, keep-alives and then ends """
+        video = clipy.models.VideoModel('abcdefghijk', dict(title='Test'))
+        stream = clipy.models.StreamModel(dict(filename='test.mp4'), video, 0)
+
+        async def listen():
+            app = aiohttp.web.Application()
+            app.router.add_get('/api/events', clipy.views.events)
+            app['actives'] = {stream.sid: stream}
+            app['scheduler'] = clipy.scheduler.DownloadScheduler(dict(), None, concurrency=0)
+            app['hub'] = clipy.events.ProgressHub(app['actives'])
+            app['scheduler'].on_transition.append(app['hub'].transition)
+            client = aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app))
+            await client.start_server()
+            try:
+                response = await client.get('/api/events')
+
+                async def read():
+                    lines = list()
+                    while True:
+                        line = await response.content.readline()
+                        if line in (b'\n', b''):
+                            return b''.join(lines)
+                        lines.append(line)
+
+                events = [response.headers['Content-Type'], await read()]
+                app['scheduler'].submit(stream)
+                events.append(await read())
+                events.append(await read())
+                await app['hub'].close()
+                events.append(await read())
+                return events
+            finally:
+                await client.close()
+
+        heartbeat, clipy.events.HEARTBEAT = clipy.events.HEARTBEAT, 0.05
+        try:
+            loop = asyncio.new_event_loop()
+            events = loop.run_until_complete(listen())
+            loop.close()
+        finally:
+            clipy.events.HEARTBEAT = heartbeat
+
+        content_type, snapshot, transition, keepalive, end = events
+        self.assertEqual(content_type, 'text/event-stream')
+        event, data = snapshot.decode().split('\n', 1)
+        self.assertEqual(event, 'event: snapshot')
+        self.assertEqual([s['sid'] for s in json.loads(data[6:])['actives']], [stream.sid])
+        event, data = transition.decode().split('\n', 1)
+        self.assertEqual(event, 'event: transition')
+        self.assertEqual(json.loads(data[6:])['state'], 'queued')
+        self.assertEqual(keepalive, b': keep-alive\n')
+        self.assertEqual(end, b'')
+
+    def test_3_progress_deltas(self):
+        """ Test that progress polls get what changed since their version, or 304 if nothing """
+        video = clipy.models.VideoModel('abcdefghijk', dict(title='Test'))
+        first, second = [clipy.models.StreamModel(dict(), video, i) for i in range(2)]
+
+        async def poll():
+            app = aiohttp.web.Application()
+            app.router.add_get('/api/progress', clipy.views.progress)
+            app['actives'] = {first.sid: first, second.sid: second}
+            app['scheduler'] = clipy.scheduler.DownloadScheduler(app['actives'], None)
+            app['state'] = clipy.events.ProgressState(app['actives'], app['scheduler'])
+            client = aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app))
+            await client.start_server()
+            try:
+                full = await (await client.get('/api/progress')).json()
+                version = full['version']
+                headers = {'If-None-Match': f'"{version}"'}
+                unchanged = await client.get(f'/api/progress?since={version}', headers=headers)
+                first.progress.advance(100)
+                del app['actives'][second.sid]
+                response = await client.get(f'/api/progress?since={version}', headers=headers)
+                return full, unchanged.status, response.headers['ETag'], await response.json()
+            finally:
+                await client.close()
+
+        loop = asyncio.new_event_loop()
+        full, unchanged, etag, delta = loop.run_until_complete(poll())
+        loop.close()
+        self.assertEqual([s['sid'] for s in full['actives']], [first.sid, second.sid])
+        self.assertEqual(unchanged, 304)
+        self.assertEqual(etag, '"{}"'.format(delta['version']))
+        self.assertGreater(delta['version'], full['version'])
+        self.assertEqual([s['sid'] for s in delta['actives']], [first.sid])
+        self.assertEqual(delta['actives'][0]['progress']['bytesdone'], 100)
+        self.assertEqual(delta['removed'], [second.sid])
+        self.assertNotIn('downloads', delta)
+
+
+class ClipySerialTest(unittest.TestCase):
+
+    def test_1_cached_encoding(self):
+        """ Test that the encoded models match their serial and are reencoded only on change """
+        video = clipy.models.VideoModel('abcdefghijk', dict(title='Test'))
+        stream = clipy.models.StreamModel(dict(itag='22', type='video/mp4'), video, 0)
+        video.streams.append(stream)
+        self.assertEqual(json.loads(video.to_json()), video.serial())
+
+        live = stream.to_json()
+        self.assertIs(stream._live, stream._encode_live())
+        stream.agent = 'YoutubeAgent'
+        stream.progress.start(100)
+        stream.progress.advance(10)
+        data = json.loads(video.to_json())
+        self.assertNotEqual(stream.to_json(), live)
+        self.assertEqual(data['streams'][0]['agent'], 'YoutubeAgent')
+        self.assertEqual(data['streams'][0]['progress']['bytesdone'], 10)
+        self.assertEqual(data, video.serial())
+
+
+class ClipyCacheTest(unittest.TestCase):
+
+    def test_1_coalesced_lookups(self):
+        """ Test that concurrent lookups for the same key make one upstream fetch """
+        cache = clipy.cache.MetadataCache()
+        fetches = []
+
+        async def fetch():
+            fetches.append(1)
+            await asyncio.sleep(0.01)
+            return dict(title='Test')
+
+        async def lookups():
+            return await asyncio.gather(*[cache.get('YoutubeAgent:vid', fetch) for i in range(5)])
+
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(lookups())
+        results.append(loop.run_until_complete(cache.get('YoutubeAgent:vid', fetch)))
+        loop.close()
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(results, [dict(title='Test')] * 6)
+
+    def test_2_expiry_and_eviction(self):
+        """ Test that entries expire before their signed URLs and the least recent is evicted """
+        cache = clipy.cache.MetadataCache(maxsize=2)
+        cache.put('expiring', 1, expires=time.time() + clipy.cache.MARGIN - 1)
+        self.assertIsNone(cache.lookup('expiring'))
+        cache.put('a', 2)
+        cache.put('b', 3)
+        self.assertEqual(cache.lookup('a'), 2)
+        cache.put('c', 4)
+        self.assertIsNone(cache.lookup('b'))
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+    def test_3_disk_store(self):
+        """ Test that unexpired entries survive a save and load """
+        path = os.path.join(tempfile.mkdtemp(), 'data', 'metadata.json')
+        cache = clipy.cache.MetadataCache(path=path)
+        cache.put('a', dict(title='Test'))
+        cache.save()
+        warm = clipy.cache.MetadataCache(path=path)
+        warm.load()
+        self.assertEqual(warm.lookup('a'), dict(title='Test'))
+
+    def test_4_cancelled_lookup(self):
+        """ Test that lookups waiting on a cancelled fetch make their own """
+        cache = clipy.cache.MetadataCache()
+        fetches = []
+
+        async def fetch():
+            fetches.append(1)
+            await asyncio.sleep(0.01)
+            return dict(title='Test')
+
+        async def lookups():
+            first = asyncio.ensure_future(cache.get('YoutubeAgent:vid', fetch))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(cache.get('YoutubeAgent:vid', fetch))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await asyncio.wait_for(second, 1)
+
+        loop = asyncio.new_event_loop()
+        result = loop.run_until_complete(lookups())
+        loop.close()
+        self.assertEqual(result, dict(title='Test'))
+        self.assertEqual(len(fetches), 2)
+        self.assertEqual(cache.inflight, {})
+
+
+class ClipyProgressTest(unittest.TestCase):
+
+    def test_1_moving_average(self):
+        """ Test that the rate follows recent throughput and is sampled once per interval """
+        now = [0.0]
+        clock, clipy.progress._clock = clipy.progress._clock, lambda: now[0]
+        try:
+            progress = clipy.progress.Progress()
+            progress.start(total=10000, offset=1000)
+            for second in range(1, 11):
+                now[0] = second
+                progress.advance(100 if second <= 5 else 500)
+                progress.advance(0)
+
+            self.assertEqual(progress.bytesdone, 4000)
+            self.assertEqual(progress.history()[-10:], [100.0] * 5 + [500.0] * 5)
+            self.assertGreater(progress.rate, 300)
+            self.assertLess(progress.rate, 500)
+            self.assertAlmostEqual(progress.eta, 6000 / progress.rate)
+            self.assertEqual(progress.elapsed, 10)
+        finally:
+            clipy.progress._clock = clock
+
+    def test_2_stalled_rate(self):
+        """ Test that the rate of a transfer receiving no data decays when it is read """
+        now = [0.0]
+        clock, clipy.progress._clock = clipy.progress._clock, lambda: now[0]
+        try:
+            progress = clipy.progress.Progress()
+            progress.start(total=10000)
+            for second in range(1, 6):
+                now[0] = second
+                progress.advance(1000)
+            rate, stamp = progress.rate, progress.stamp
+            self.assertEqual(rate, 1000)
+
+            now[0] = 5.2
+            self.assertEqual(progress.rate, rate)
+            now[0] = 20
+            self.assertLess(progress.rate, rate / 10)
+            self.assertNotEqual(progress.stamp, stamp)
+            self.assertEqual(progress.history()[-1], 0.0)
+
+            progress.advance(5000)
+            now[0] = 40
+            done = progress.rate
+            self.assertEqual(progress.rate, done)
+        finally:
+            clipy.progress._clock = clock
+
+
+class ClipyMetricsTest(ClipyOriginTestCase):
+
+    def test_1_text_format(self):
+        """ Test that counters and histograms render in the Prometheus text format """
+        registry = list()
+        counter = clipy.metrics.Counter('t_total', 'Things', ('kind',), registry=registry)
+        histogram = clipy.metrics.Histogram('t_seconds', 'Time', buckets=(0.1, 1, float('inf')),
+                                            registry=registry)
+        counter.labels('a"b').inc(3)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEqual(clipy.metrics.render(registry).splitlines(), [
+            '# HELP t_total Things',
+            '# TYPE t_total counter',
+            't_total{kind="a\\"b"} 3',
+            '# HELP t_seconds Time',
+            '# TYPE t_seconds histogram',
+            't_seconds_bucket{le="0.1"} 1',
+            't_seconds_bucket{le="1"} 2',
+            't_seconds_bucket{le="+Inf"} 3',
+            't_seconds_sum 5.55',
+            't_seconds_count 3',
+        ])
+
+    def test_2_download_bytes(self):
+        """ Test that the bytes of a download are counted by agent and host """
+        counter = clipy.metrics.DOWNLOAD_BYTES.labels('unknown', '127.0.0.1')
+        before = counter.value
+
+        async def download(make_stream, session):
+            return await clipy.download.get(make_stream(), dict(), session)
+
+        self.download(download)
+        self.assertEqual(counter.value - before, len(self.data))
+
+    def test_3_upstream_outcomes(self):
+        """ Test that upstream requests are timed whether they succeed or fail """
+        def count(outcome):
+            return sum(clipy.metrics.UPSTREAM_SECONDS.labels('127.0.0.1', outcome).counts)
+
+        async def inquire(make_stream, session):
+            url = make_stream().url
+            await clipy.request.get_text(session, url + '.txt')
+            with self.assertRaises(aiohttp.ContentTypeError):
+                await clipy.request.get_json(session, url)
+
+        before = count('ok'), count('error')
+        self.download(inquire)
+        self.assertEqual((count('ok'), count('error')), (before[0] + 1, before[1] + 1))
+
+
+class ClipyMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_1_slow_callbacks(self):
+        """ Test that callbacks holding the loop are reported without debug mode """
+        def block():
+            time.sleep(0.03)
+
+        def quick():
+            pass
+
+        run = asyncio.events.Handle._run
+        monitor = clipy.monitor.SlowCallbackMonitor()
+        monitor.enable(0.02)
+        try:
+            self.loop.call_soon(quick)
+            self.loop.call_soon(block)
+            self.loop.run_until_complete(asyncio.sleep(0))
+        finally:
+            monitor.disable()
+
+        self.assertFalse(self.loop.get_debug())
+        self.assertIs(asyncio.events.Handle._run, run)
+        self.assertEqual(monitor.count, 1)
+        self.assertIn('block', monitor.recent[0]['callback'])
+
+    def test_2_profiles(self):
+        """ Test that a profile of the running loop is taken in both modes """
+        async def busy():
+            while True:
+                time.sleep(0.002)
+                await asyncio.sleep(0)
+
+        async def profile():
+            task = asyncio.ensure_future(busy())
+            try:
+                return await clipy.monitor.profile(0.05), await clipy.monitor.sample(0.05)
+            finally:
+                task.cancel()
+
+        stats, stacks = self.loop.run_until_complete(profile())
+        self.assertTrue(any(name == 'busy' for _, _, name in marshal.loads(stats)))
+        self.assertIn(b'busy (tests.py:', stacks)
+
+
+class ClipyWriterTest(unittest.TestCase):
+
+    def test_1_aligned_batches(self):
+        """ Test that chunks are written in order as reused batches ending on aligned offsets """
+        path = os.path.join(tempfile.mkdtemp(), 'video.clipy')
+        data = os.urandom(5000)
+        writes = []
+
+        def pwrite(fd, buffer, length, position):
+            writes.append((position, length))
+            return pwrite_(fd, buffer, length, position)
+
+        async def write():
+            writer = clipy.writer.FileWriter(path, batch=1024, depth=2)
+            await writer.open(position=100, truncate=100)
+            for i in range(0, len(data), 300):
+                await writer.write(data[i:i + 300])
+            await writer.close(fsync=True)
+            self.assertLessEqual(len(writer.free), 3)
+
+        pwrite_, clipy.writer._pwrite = clipy.writer._pwrite, pwrite
+        align, clipy.writer.ALIGN = clipy.writer.ALIGN, 512
+        try:
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(write())
+            loop.close()
+        finally:
+            clipy.writer._pwrite, clipy.writer.ALIGN = pwrite_, align
+
+        with open(path, 'rb') as fd:
+            self.assertEqual(fd.read(), bytes(100) + data)
+        self.assertEqual(writes[0], (100, 924))
+        self.assertTrue(all((p + n) % 512 == 0 for p, n in writes[:-1]))
+        self.assertEqual(sum(n for p, n in writes), len(data))
+
+    def test_2_write_error(self):
+        """ Test that a failed write is raised to a writer waiting for room in the queue """
+        path = os.path.join(tempfile.mkdtemp(), 'video.clipy')
+
+        def pwrite(fd, buffer, length, position):
+            raise OSError(28, 'No space left on device')
+
+        async def write():
+            writer = clipy.writer.FileWriter(path, batch=2**16, depth=1)
+            await writer.open()
+            try:
+                with self.assertRaises(OSError):
+                    await writer.write(bytes(2**18))
+            finally:
+                await clipy.writer.run(os.close, writer.fd)
+
+        pwrite_, clipy.writer._pwrite = clipy.writer._pwrite, pwrite
+        try:
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(asyncio.wait_for(write(), 5))
+            loop.close()
+        finally:
+            clipy.writer._pwrite = pwrite_
+
+    def test_3_preallocate(self):
+        """ Test that a full disk fails the open and a file system without fallocate does not """
+        path = os.path.join(tempfile.mkdtemp(), 'video.clipy')
+        errors = []
+
+        def fallocate(fd, offset, length):
+            raise OSError(errors.pop(0), 'fallocate')
+
+        async def open_writer():
+            writer = clipy.writer.FileWriter(path)
+            await writer.open(truncate=0, preallocate=1000)
+            await writer.close()
+
+        fallocate_ = getattr(os, 'posix_fallocate', None)
+        os.posix_fallocate = fallocate
+        try:
+            loop = asyncio.new_event_loop()
+            errors.append(errno.EOPNOTSUPP)
+            loop.run_until_complete(open_writer())
+            self.assertEqual(os.path.getsize(path), 1000)
+            errors.append(errno.ENOSPC)
+            with self.assertRaises(OSError):
+                loop.run_until_complete(open_writer())
+            loop.close()
+        finally:
+            if fallocate_ is None:
+                del os.posix_fallocate
+            else:
+                os.posix_fallocate = fallocate_
+
+
+class ClipyThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.clock, clipy.throttle._clock = clipy.throttle._clock, lambda: self.now
+
+    def tearDown(self):
+        clipy.throttle._clock = self.clock
+
+    def test_1_token_bucket(self):
+        """ Test that a bucket allows a burst and then paces takers to its rate """
+        bucket = clipy.throttle.TokenBucket(rate=1000)
+        self.now = 10.0
+        self.assertEqual(bucket.take(1000), 0.0)
+        self.assertEqual(bucket.take(500), 0.5)
+        self.assertEqual(bucket.take(500), 1.0)
+        self.now = 11.0
+        self.assertEqual(bucket.take(0), 0.0)
+
+    def test_2_stream_limits(self):
+        """ Test that a stream limit applies on top of the global limit and can be removed """
+        limiter = clipy.throttle.BandwidthLimiter()
+        self.assertEqual(limiter.delay('a', 10**9), 0.0)
+        limiter.limit(100, sid='a')
+        limiter.limit(1000)
+        self.assertEqual(limiter.delay('a', 200), 1.0)
+        self.assertEqual(limiter.delay('b', 700), 0.0)
+        self.assertEqual(limiter.serial(), dict(rate=1000, streams=dict(a=100)))
+        limiter.limit(0, sid='a')
+        self.assertEqual(limiter.serial(), dict(rate=1000, streams=dict()))
+
+
 if __name__ == '__main__':
     # import pdb; pdb.set_trace()
     unittest.main()